@@ -1,19 +1,99 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Response, Request, Depends
+from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, TypeAdapter, ValidationError
 from typing import List
+from dataclasses import dataclass
 import os
+import time
+import hashlib
+import threading
+import orjson
+from contextlib import asynccontextmanager
 
 # Importamos tu clase original (modelo.py)
 from modelo import SistemaSalonDB
 
-app = FastAPI(title="Sistema Salon Cloud", version="1.0")
+class ORJSONResponse(JSONResponse):
+    """Respuesta JSON serializada con orjson (en Rust, directo a bytes)"""
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
 
 # Conectamos con la base de datos que moviste a esta carpeta
 nombre_db = "salon_sistema_pro.db"
-if not os.path.exists(nombre_db):
-    print(f"ADVERTENCIA: No encuentro {nombre_db}, se creará una nueva vacía.")
 
-db = SistemaSalonDB(nombre_db)
+@asynccontextmanager
+async def lifespan(app):
+    # La base se abre al arrancar el servidor (no al importar este módulo) y se cierra al apagarlo
+    if not os.path.exists(nombre_db):
+        print(f"ADVERTENCIA: No encuentro {nombre_db}, se creará una nueva vacía.")
+    # Cada worker de uvicorn pasa por aquí después del fork y abre sus propias conexiones
+    app.state.db = SistemaSalonDB(nombre_db)
+    print(f"Base de datos lista en el worker pid={os.getpid()}")
+    yield
+    app.state.db.cerrar()
+
+app = FastAPI(title="Sistema Salon Cloud", version="1.0", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Las listas (/citas, /productos) repiten las mismas claves en cada fila: comprimen muy bien.
+# Respuestas pequeñas (< 500 bytes) salen sin comprimir, no vale la pena el costo.
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
+# Las rutas se declaran con 'def' (no 'async def'): FastAPI las corre en su pool de hilos
+# y cada hilo reutiliza su propia conexión SQLite (modo WAL), así las lecturas no se
+# bloquean entre sí ni detienen el bucle de eventos. Todas las consultas de una misma
+# petición usan la conexión del hilo que la atiende. Los POST 'async' de más abajo
+# mandan igual su trabajo con la DB al pool con run_in_threadpool.
+# get_db sí es 'async': solo lee un atributo, y así FastAPI no gasta un salto al pool
+# de hilos por cada petición solo para resolver la dependencia.
+async def get_db(request: Request) -> SistemaSalonDB:
+    return request.app.state.db
+
+# --- CACHÉ EN MEMORIA (con vencimiento) PARA LECTURAS FRECUENTES ---
+# Guardamos el JSON ya serializado (bytes): un acierto no toca la DB ni vuelve a codificar.
+CACHE_TTL = 30  # segundos
+_cache = {}         # clave -> (json_bytes, etag, vence_en)
+_cache_version = {} # clave -> contador; cambia en cada invalidación
+_cache_lock = threading.Lock()
+
+def leer_cache(clave, cargar):
+    """Retorna (json, etag) guardados para 'clave' o los regenera con cargar() si vencieron"""
+    item = _cache.get(clave)
+    if item and item[2] > time.monotonic():
+        return item[0], item[1]
+    version = _cache_version.get(clave, 0)
+    contenido = orjson.dumps(cargar())
+    # El ETag sale del contenido: cambia solo si los datos cambian (venga de donde venga el cambio).
+    # Es débil (W/): GZipMiddleware entrega el mismo recurso comprimido o no con la misma etiqueta
+    etag = 'W/"' + hashlib.blake2b(contenido, digest_size=8).hexdigest() + '"'
+    with _cache_lock:
+        # Si hubo una escritura mientras cargábamos, no guardamos datos viejos
+        if _cache_version.get(clave, 0) == version:
+            _cache[clave] = (contenido, etag, time.monotonic() + CACHE_TTL)
+    return contenido, etag
+
+def invalidar_cache(clave):
+    with _cache_lock:
+        _cache_version[clave] = _cache_version.get(clave, 0) + 1
+        _cache.pop(clave, None)
+
+def etag_coincide(if_none_match, etag):
+    """Comparación débil de If-None-Match: lista separada por comas, '*' coincide con todo"""
+    for token in if_none_match.split(","):
+        token = token.strip()
+        if token == "*" or token.removeprefix("W/") == etag.removeprefix("W/"):
+            return True
+    return False
+
+def respuesta_cacheada(request, clave, cargar):
+    """Responde desde la caché con ETag: si el cliente ya tiene esa versión, 304 sin cuerpo"""
+    contenido, etag = leer_cache(clave, cargar)
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=5"}
+    if etag_coincide(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=contenido, media_type="application/json", headers=headers)
 
 # --- 1. DEFINIR CÓMO SON LOS DATOS (Esquemas) ---
 # Esto sirve para que la API sepa qué datos pedir y entregar
@@ -28,36 +108,67 @@ class ProductoSchema(BaseModel):
     precio: float
     stock: int
 
+# Filas de salida: dataclasses livianas (slots) que orjson serializa directo, sin armar dicts
+@dataclass(slots=True)
+class ProductoFila:
+    id: int
+    nombre: str
+    precio: float
+    stock: int
+
+@dataclass(slots=True)
+class CitaFila:
+    id: int
+    fecha: str
+    hora: str
+    cliente: str
+    servicio: str
+    profesional: str
+    estado: str
+
+# Validadores compilados una sola vez al importar. Los POST más usados leen el cuerpo crudo
+# y lo validan directo desde los bytes (núcleo en Rust), sin el envoltorio de FastAPI.
+_LOGIN_TA = TypeAdapter(LoginRequest)
+
+def cuerpo_json(modelo):
+    """Documenta en OpenAPI el cuerpo de una ruta que lo valida por su cuenta"""
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": modelo.model_json_schema()}}}}
+
+async def leer_cuerpo(request, adaptador):
+    """Valida el cuerpo de la petición; si no cumple el esquema responde 422 como FastAPI"""
+    try:
+        return adaptador.validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)])
+
 # --- 2. CREAR LAS RUTAS (Puntos de Acceso) ---
 
+# Respuesta fija: se codifica una sola vez al cargar el módulo
+_HOME_JSON = orjson.dumps({"mensaje": "¡Hola Franklin! Tu sistema ya está corriendo en la web 🚀"})
+
 @app.get("/")
 def home():
-    return {"mensaje": "¡Hola Franklin! Tu sistema ya está corriendo en la web 🚀"}
+    return Response(content=_HOME_JSON, media_type="application/json")
 
-@app.post("/login")
-def login(datos: LoginRequest):
-    # Usamos tu función original 'validar_login'
-    exito = db.validar_login(datos.usuario, datos.password)
+@app.post("/login", openapi_extra=cuerpo_json(LoginRequest))
+async def login(request: Request, db: SistemaSalonDB = Depends(get_db)):
+    datos = await leer_cuerpo(request, _LOGIN_TA)
+    # Usamos tu función original 'validar_login' (bloqueante: va al pool de hilos)
+    exito = await run_in_threadpool(db.validar_login, datos.usuario, datos.password)
     if exito:
         return {"status": "ok", "mensaje": "Bienvenido al sistema"}
     else:
         raise HTTPException(status_code=401, detail="Usuario o clave incorrectos")
 
-@app.get("/productos", response_model=List[ProductoSchema])
-def obtener_productos():
-    # Usamos tu función original 'traer_productos'
-    lista_tuplas = db.traer_productos()
-    
-    # Convertimos las tuplas de tu DB a Diccionarios para la web
-    resultado = []
-    for p in lista_tuplas:
-        resultado.append({
-            "id": p[0],
-            "nombre": p[1],
-            "precio": p[2],
-            "stock": p[3]
-        })
-    return resultado
+# Sin response_model: los datos salen de nuestra propia DB y ya tienen la forma final,
+# así que no se revalidan fila por fila. El esquema queda solo para la documentación.
+@app.get("/productos", responses={200: {"model": List[ProductoSchema]}})
+def obtener_productos(request: Request, db: SistemaSalonDB = Depends(get_db)):
+    return respuesta_cacheada(request, "productos", lambda: _cargar_productos(db))
+
+def _cargar_productos(db):
+    # Usamos tu función original 'traer_productos' (id, nombre, precio, stock)
+    return [ProductoFila(*p) for p in db.traer_productos()]
 # --- Pega esto al final de main.py ---
 
 class NuevoProducto(BaseModel):
@@ -65,12 +176,16 @@ class NuevoProducto(BaseModel):
     precio: float
     stock: int
 
-@app.post("/crear-producto")
-def crear_producto(datos: NuevoProducto):
+_NUEVO_PRODUCTO_TA = TypeAdapter(NuevoProducto)
+
+@app.post("/crear-producto", openapi_extra=cuerpo_json(NuevoProducto))
+async def crear_producto(request: Request, db: SistemaSalonDB = Depends(get_db)):
+    datos = await leer_cuerpo(request, _NUEVO_PRODUCTO_TA)
     # Usamos tu función original del modelo
-    exito, mensaje = db.crear_producto(datos.nombre, datos.precio, datos.stock)
+    exito, mensaje = await run_in_threadpool(db.crear_producto, datos.nombre, datos.precio, datos.stock)
     
     if exito:
+        invalidar_cache("productos")
         return {"status": "ok", "mensaje": mensaje}
     else:
         raise HTTPException(status_code=400, detail=mensaje)
@@ -85,34 +200,15 @@ class CitaInput(BaseModel):
     fecha: str  # Formato YYYY-MM-DD
     hora: str   # Formato HH:MM
 
-# 2. Endpoint para AGENDAR (Crear)
-@app.post("/agendar")
-def agendar_cita(cita: CitaInput):
-    # A. Buscamos info del servicio (precio y duración)
-    info_srv = db.get_info_servicio(cita.servicio)
-    if not info_srv:
-        raise HTTPException(status_code=400, detail="El servicio no existe")
-    
-    id_srv, duracion, precio = info_srv
+_CITA_TA = TypeAdapter(CitaInput)
 
-    # B. Validamos si hay choque de horario (¡Usando tu lógica original!)
-    ocupado, fin_msg = db.validar_choque(cita.fecha, cita.hora, duracion, cita.profesional)
-    
-    if ocupado:
-        raise HTTPException(status_code=400, detail=f"Ocupado: {fin_msg}")
-
-    # C. Preparamos el paquete para guardar (tu modelo espera una lista 'carrito')
-    item_cita = {
-        'servicio': cita.servicio,
-        'profesional': cita.profesional,
-        'inicio': cita.hora,
-        'fin': fin_msg,
-        'fecha': cita.fecha,
-        'precio': precio
-    }
-    
-    # D. Guardamos usando tu función maestra
-    ok, msg = db.guardar_paquete_citas([item_cita], cita.cliente, cita.telefono)
+# 2. Endpoint para AGENDAR (Crear)
+@app.post("/agendar", openapi_extra=cuerpo_json(CitaInput))
+async def agendar_cita(request: Request, db: SistemaSalonDB = Depends(get_db)):
+    cita = await leer_cuerpo(request, _CITA_TA)
+    # Todo en una sola transacción del modelo: info del servicio (precio y duración),
+    # choque de horario, cliente y guardado de la cita
+    ok, msg = await run_in_threadpool(db.agendar_cita, cita.cliente, cita.telefono, cita.profesional, cita.servicio, cita.fecha, cita.hora)
     
     if ok:
         return {"status": "ok", "mensaje": f"Cita Agendada: {msg}"}
@@ -121,26 +217,35 @@ def agendar_cita(cita: CitaInput):
 
 # 3. Endpoint para LISTAR (Ver Agenda)
 @app.get("/citas")
-def listar_citas():
+def listar_citas(db: SistemaSalonDB = Depends(get_db)):
     # Usamos tu función que trae la agenda filtrada
     filas = db.traer_agenda_filtrada()
     
-    lista_json = []
     # Convertimos las tuplas a JSON: (id, fecha, hora, cli, tel, srv, pro, est)
-    for r in filas:
-        lista_json.append({
-            "id": r[0],
-            "fecha": r[1],
-            "hora": r[2],
-            "cliente": r[3],
-            "servicio": r[5],
-            "profesional": r[6],
-            "estado": r[7]
-        })
-    return lista_json
+    # Se devuelve la respuesta ya armada para que orjson serialice las filas directamente
+    return ORJSONResponse([CitaFila(r[0], r[1], r[2], r[3], r[5], r[6], r[7]) for r in filas])
 
 # 4. Auxiliar: Listas para llenar los Combobox (Desplegables)
 @app.get("/listas-agenda")
-def obtener_listas():
+def obtener_listas(request: Request, db: SistemaSalonDB = Depends(get_db)):
+    # Profesionales y servicios casi nunca cambian: se sirven desde la caché
+    return respuesta_cacheada(request, "listas-agenda", lambda: _cargar_listas(db))
+
+def _cargar_listas(db):
     pros, servs = db.get_listas()
-    return {"profesionales": pros, "servicios": servs}
\ No newline at end of file
+    return {"profesionales": pros, "servicios": servs}
+# --- ARRANQUE DEL SERVIDOR ---
+# uvloop (bucle de eventos en C) y httptools (parser HTTP en C) reemplazan a asyncio/h11.
+# En producción: uvicorn main:app --workers 4 --loop uvloop --http httptools --limit-concurrency 1000 --timeout-keep-alive 30
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=os.cpu_count() or 1,
+        loop="uvloop" if os.name != "nt" else "asyncio",  # uvloop no existe en Windows
+        http="httptools",
+        limit_concurrency=1000,
+        timeout_keep_alive=30,
+    )
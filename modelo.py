@@ -1,16 +1,29 @@
 import sqlite3
-import pandas as pd
 from datetime import datetime, timedelta
 import os
-import hashlib  # Para encriptar contraseñas
+import hmac     # Comparación de hashes en tiempo constante
 import shutil   # Para copiar archivos (Backup y Logo)
 import json     # Para guardar la configuración de campos obligatorios
+import threading  # Pool de conexiones (una por hilo)
+import atexit
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import groupby
+from hashlib import sha256 as _sha256, scrypt as _scrypt
 
 # Importaciones opcionales para Excel y PDF
 try:
     from openpyxl import Workbook, load_workbook
+    from openpyxl.cell import WriteOnlyCell
     from openpyxl.styles import PatternFill, Alignment, Border, Side, Font
     HAS_OPENPYXL = True
+    # Estilos de los libros de Excel: se crean una sola vez y se comparten entre todas las celdas
+    _XL_FILL_HEADER = PatternFill("solid", fgColor="D3D3D3")
+    _XL_FILL_CITA = PatternFill("solid", fgColor="90EE90")
+    _XL_CENTRO = Alignment(horizontal='center', vertical='center', wrap_text=True)
+    _XL_BORDE = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+    _XL_NEGRITA = Font(bold=True)
+    _XL_ENCABEZADO = Alignment(horizontal='center', vertical='top')
 except ImportError:
     HAS_OPENPYXL = False
 
@@ -19,186 +32,445 @@ try:
     from reportlab.lib.pagesizes import letter
     from reportlab.lib.units import mm
     from reportlab.lib import colors
+    from reportlab.lib.utils import ImageReader
     HAS_REPORTLAB = True
 except ImportError:
     HAS_REPORTLAB = False
 
+# ==========================================
+#  HELPERS: HORAS COMO MINUTOS
+# ==========================================
+# Tablas precalculadas con las 1440 horas del día: convertir es una sola búsqueda
+_MIN2HM = [f"{h:02d}:{m:02d}" for h in range(24) for m in range(60)]
+_HM2MIN = {hm: i for i, hm in enumerate(_MIN2HM)}
+
+def _hm_a_min(hora):
+    """Convierte '09:30' a minutos desde la medianoche (570)"""
+    try:
+        return _HM2MIN[hora]
+    except KeyError:
+        # Formatos sin ceros ('9:30'); lo demás es una hora inválida
+        h, m = hora.split(':')
+        return _HM2MIN[f"{int(h):02d}:{int(m):02d}"]
+
+def _min_a_hm(minutos):
+    """Convierte minutos desde la medianoche a 'HH:MM' (después de 24:00 vuelve a 00:00)"""
+    return _MIN2HM[minutos % 1440]
+
+def _hora_hm(hora):
+    """Rellena con ceros una hora 'H:MM' -> 'HH:MM' (así las horas guardadas se comparan bien como texto)"""
+    if len(hora) == 5: return hora
+    h, m = hora.split(':')[:2]
+    return f"{int(h):02d}:{int(m):02d}"
+
+def _cortar(txt, largo=22):
+    """Corta un texto largo para el ticket: 'Servicio muy largo...'"""
+    return txt if len(txt) <= largo else txt[:largo] + "..."
+
+# ==========================================
+#  HELPERS: TRADUCTORES DE FECHAS
+# ==========================================
+# Las mismas fechas se repiten en casi todas las filas (la de hoy sobre todo):
+# cada conversión se calcula una vez y luego sale de la caché
+_FMT_ISO = "%Y-%m-%d"
+_FMT_UI = "%d-%m-%y"
+
+@lru_cache(maxsize=4096)
+def _f_to_iso(fecha_ui):
+    """Convierte '21-12-25' (App) a '2025-12-21' (Base de Datos)"""
+    try:
+        return datetime.strptime(fecha_ui, _FMT_UI).strftime(_FMT_ISO)
+    except:
+        return fecha_ui # Si falla, retorna original
+
+@lru_cache(maxsize=4096)
+def _f_to_ui(fecha_iso):
+    """Convierte '2025-12-21' (Base de Datos) a '21-12-25' (App)"""
+    try:
+        return datetime.strptime(fecha_iso, _FMT_ISO).strftime(_FMT_UI)
+    except:
+        return fecha_iso
+
+_COLS_TERCERO = ("doc_id", "nombre1", "nombre2", "apellido1", "apellido2", "nombre_completo",
+                 "direccion", "telefono", "email", "ciudad",
+                 "es_cliente", "es_proveedor", "es_empleado",
+                 "comision", "color_agenda", "servicios_asignados")
+_SQL_INSERT_TERCERO = (f"INSERT INTO terceros ({', '.join(_COLS_TERCERO)}, fecha_registro) "
+                       f"VALUES ({', '.join('?' * (len(_COLS_TERCERO) + 1))})")
+# Nota: el UPDATE no toca fecha_registro
+_SQL_UPDATE_TERCERO = f"UPDATE terceros SET {', '.join(f'{c}=?' for c in _COLS_TERCERO)} WHERE id=?"
+
+def _sql_f_ui(col):
+    """Expresión SQL equivalente a f_to_ui: 'YYYY-MM-DD' -> 'DD-MM-YY' dentro de la consulta,
+    así las filas ya salen formateadas (lo que no es una fecha válida queda igual)"""
+    return f"CASE WHEN date({col}) = {col} THEN strftime('%d-%m-', {col}) || substr({col}, 3, 2) ELSE {col} END"
+
+def _frase_fts(texto):
+    """Texto de búsqueda como frase FTS5 entre comillas: se busca literal, no como sintaxis"""
+    return '"' + texto.replace('"', '""') + '"'
+
+# Esquema completo de la base. Todo con IF NOT EXISTS: se puede correr en cada arranque.
+_ESQUEMA = '''
+-- --- NUEVA TABLA UNIFICADA DE TERCEROS ---
+-- Reemplaza a clientes, proveedores y profesionales individuales.
+-- Permite tener roles mixtos (Ej: Empleado que también es Cliente).
+CREATE TABLE IF NOT EXISTS terceros (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+
+    -- Identificación y Nombres
+    doc_id TEXT UNIQUE,       -- Cédula, NIT o RUT
+    nombre1 TEXT,             -- Primer Nombre
+    nombre2 TEXT,             -- Segundo Nombre
+    apellido1 TEXT,           -- Primer Apellido
+    apellido2 TEXT,           -- Segundo Apellido
+    nombre_completo TEXT,     -- Campo calculado (Concatenación) para búsquedas rápidas
+
+    -- Datos de Contacto
+    direccion TEXT,
+    telefono TEXT,
+    email TEXT,
+    ciudad TEXT,
+    fecha_nacimiento TEXT,
+
+    -- ROLES (Banderas booleanas 0/1)
+    es_cliente INTEGER DEFAULT 0,
+    es_proveedor INTEGER DEFAULT 0,
+    es_empleado INTEGER DEFAULT 0,
+
+    -- Datos Específicos de Empleado
+    comision REAL DEFAULT 0,
+    color_agenda TEXT,
+    servicios_asignados TEXT, -- "Corte,Tinte" o "TODOS"
+
+    -- Metadatos
+    fecha_registro TEXT,
+    notas_internas TEXT);
+
+-- --- MIGRACIÓN DE DATOS ANTIGUOS (SI EXISTEN) ---
+-- Si existían tablas viejas, idealmente aquí se haría un script de migración.
+-- Para este código, asumimos que si no existen las tablas viejas, usamos la nueva lógica.
+-- Mantenemos las definiciones viejas COMENTADAS o como respaldo si se requiere compatibilidad,
+-- pero el sistema ahora priorizará 'terceros'.
+
+-- 1. Tablas Maestras de Configuración y Servicios
+CREATE TABLE IF NOT EXISTS servicios (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, nombre TEXT UNIQUE, duracion_min INTEGER, precio REAL);
+CREATE TABLE IF NOT EXISTS medios_pago (nombre TEXT UNIQUE);
+-- configuracion solo se consulta por clave: WITHOUT ROWID guarda todo en el árbol de la llave
+CREATE TABLE IF NOT EXISTS configuracion (clave TEXT PRIMARY KEY NOT NULL, valor TEXT) WITHOUT ROWID;
+
+-- TABLA USUARIOS (LOGIN)
+CREATE TABLE IF NOT EXISTS usuarios (
+    usuario TEXT PRIMARY KEY,
+    password_hash TEXT,
+    rol TEXT DEFAULT 'admin');
+
+-- --- TABLAS INVENTARIO ---
+CREATE TABLE IF NOT EXISTS productos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    nombre TEXT UNIQUE,
+    precio REAL,
+    stock INTEGER,
+    codigo_barras TEXT);
+
+CREATE TABLE IF NOT EXISTS ventas_productos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cita_id INTEGER,
+    producto_id INTEGER,
+    cantidad INTEGER,
+    precio_unitario REAL,
+    fecha TEXT,
+    FOREIGN KEY(cita_id) REFERENCES citas(id));
+
+-- --- TABLAS DE COMPRAS (Integradas con Terceros) ---
+CREATE TABLE IF NOT EXISTS compras (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    proveedor_id INTEGER, -- Referencia a tabla terceros
+    fecha TEXT,
+    total REAL,
+    metodo_pago TEXT,
+    estado TEXT, -- 'Pagado' o 'Pendiente'
+    observacion TEXT);
+
+CREATE TABLE IF NOT EXISTS detalle_compras (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    compra_id INTEGER,
+    producto_id INTEGER,
+    cantidad INTEGER,
+    costo_unitario REAL,
+    FOREIGN KEY(compra_id) REFERENCES compras(id));
+
+CREATE TABLE IF NOT EXISTS abonos_proveedores (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    compra_id INTEGER,
+    monto REAL,
+    fecha TEXT,
+    metodo TEXT);
+
+-- 2. Operativas (Citas referencia a Terceros)
+CREATE TABLE IF NOT EXISTS citas (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cliente_id INTEGER,      -- Referencia a terceros (es_cliente=1)
+    profesional_id INTEGER,  -- Referencia a terceros (es_empleado=1)
+    servicio_id INTEGER,
+    fecha TEXT, hora_inicio TEXT, hora_fin TEXT, estado TEXT DEFAULT 'Pendiente',
+    precio_final REAL, descuento REAL DEFAULT 0, nomina_pagada INTEGER DEFAULT 0);
+
+-- 3. Financieras
+CREATE TABLE IF NOT EXISTS pagos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, cita_id INTEGER, metodo TEXT, monto REAL, fecha TEXT, hora TEXT, descripcion_extra TEXT);
+CREATE TABLE IF NOT EXISTS gastos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, fecha TEXT, tipo TEXT, categoria TEXT, descripcion TEXT, metodo TEXT, valor REAL);
+
+-- Prestamos (Referencia a Terceros Empleados)
+CREATE TABLE IF NOT EXISTS prestamos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, profesional_id INTEGER, monto REAL, fecha TEXT, estado TEXT DEFAULT 'Pendiente', descripcion TEXT);
+CREATE TABLE IF NOT EXISTS abonos_prestamos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, prestamo_id INTEGER, valor REAL, fecha TEXT, descripcion TEXT, metodo TEXT);
+
+-- 4. Control
+CREATE TABLE IF NOT EXISTS bloqueos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, profesional_id INTEGER, fecha TEXT, hora_inicio TEXT, hora_fin TEXT, motivo TEXT);
+
+-- 5. AUDITORÍA (Logs de seguridad)
+CREATE TABLE IF NOT EXISTS auditoria (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    fecha TEXT,
+    hora TEXT,
+    accion TEXT,
+    detalle TEXT,
+    usuario TEXT DEFAULT 'Admin');
+
+-- 6. ÍNDICES (consultas frecuentes)
+-- Choques de horario e intervalos ocupados: profesional + fecha, con las horas dentro del índice
+CREATE INDEX IF NOT EXISTS idx_citas_pro_fecha ON citas(profesional_id, fecha, hora_inicio, hora_fin, estado);
+-- Agenda por día, ya ordenada por hora
+CREATE INDEX IF NOT EXISTS idx_citas_fecha_hora ON citas(fecha, hora_inicio, estado);
+-- Terceros por nombre: listados ORDER BY nombre_completo sin ordenar aparte
+-- (nombre_completo no es columna generada: editar_cliente y los clientes rápidos la escriben directo)
+CREATE INDEX IF NOT EXISTS idx_terceros_nombre ON terceros(nombre_completo);
+-- Terceros por rol (índices parciales: solo las filas de ese rol)
+CREATE INDEX IF NOT EXISTS idx_terceros_empleado ON terceros(nombre_completo) WHERE es_empleado=1;
+CREATE INDEX IF NOT EXISTS idx_terceros_proveedor ON terceros(nombre_completo, telefono, direccion) WHERE es_proveedor=1;
+CREATE INDEX IF NOT EXISTS idx_terceros_cliente ON terceros(nombre_completo, telefono, doc_id) WHERE es_cliente=1;
+-- Cuentas por pagar: compras a crédito pendientes y sus abonos
+CREATE INDEX IF NOT EXISTS idx_compras_pendientes ON compras(proveedor_id) WHERE metodo_pago='CREDITO' AND estado='Pendiente';
+CREATE INDEX IF NOT EXISTS idx_abonos_prov_compra ON abonos_proveedores(compra_id, monto);
+-- Comisiones por liquidar: solo las citas pagadas que aún no entran en nómina
+CREATE INDEX IF NOT EXISTS idx_citas_nomina_pendiente ON citas(profesional_id, fecha) WHERE estado='Pagado' AND nomina_pagada=0;
+-- Citas de un cliente (próximas citas, deudas por cliente)
+CREATE INDEX IF NOT EXISTS idx_citas_cliente ON citas(cliente_id);
+-- Caja y balance: pagos y gastos por rango de fechas
+CREATE INDEX IF NOT EXISTS idx_pagos_fecha ON pagos(fecha);
+CREATE INDEX IF NOT EXISTS idx_gastos_fecha ON gastos(fecha);
+-- Bloqueos del día (agenda visual, choques)
+CREATE INDEX IF NOT EXISTS idx_bloqueos_fecha_pro ON bloqueos(fecha, profesional_id);
+-- Préstamos de un profesional por estado (liquidación, estado de cuenta)
+CREATE INDEX IF NOT EXISTS idx_prestamos_pro_estado ON prestamos(profesional_id, estado);
+-- Deudas pendientes (índices parciales: solo créditos de clientes y préstamos sin saldar)
+CREATE INDEX IF NOT EXISTS idx_pagos_credito ON pagos(fecha, cita_id) WHERE metodo='CREDITO';
+CREATE INDEX IF NOT EXISTS idx_prestamos_pendientes ON prestamos(profesional_id, fecha) WHERE estado='Pendiente';
+'''
+
+# Ajustes de cada conexión nueva (se aplican en un solo llamado)
+_PRAGMAS_CONEXION = """
+PRAGMA synchronous=NORMAL;      -- Con WAL: sin fsync en cada COMMIT (un apagón pierde lo último, nunca corrompe)
+PRAGMA cache_size=-64000;       -- Hasta 64 MB de páginas en memoria
+PRAGMA temp_store=MEMORY;       -- Tablas temporales (ORDER BY, GROUP BY) en RAM
+PRAGMA mmap_size=268435456;     -- Lecturas por mmap (hasta 256 MB)
+"""
+
+# SQL fijo de las escrituras más usadas: el mismo texto siempre, así sqlite3 reutiliza
+# la sentencia ya preparada de su caché en vez de volver a compilarla
+_SQL_INSERT_CITA = ("INSERT INTO citas (cliente_id, profesional_id, servicio_id, fecha, hora_inicio, hora_fin, precio_final, estado) "
+                    "VALUES (?,?,?,?,?,?,?, 'Pendiente')")
+_SQL_INSERT_PAGO = "INSERT INTO pagos (cita_id, metodo, monto, fecha, hora, descripcion_extra) VALUES (?,?,?,?,?,?)"
+_SQL_INSERT_GASTO = "INSERT INTO gastos (fecha, tipo, categoria, descripcion, metodo, valor) VALUES (?,?,?,?,?,?)"
+# Búsqueda de profesional por nombre (la usan casi todas las pantallas de agenda y nómina)
+_SQL_EMPLEADO_POR_NOMBRE = "SELECT id FROM terceros WHERE nombre_completo=? AND es_empleado=1 ORDER BY id LIMIT 1"
+
+# ==========================================
+#  HELPERS: CLAVES
+# ==========================================
+# scrypt con sal aleatoria, guardado como 'sal$hash' en hex. Las claves viejas (sha256 sin sal)
+# se siguen aceptando y se convierten a scrypt en el siguiente ingreso correcto.
+_SCRYPT = dict(n=2**14, r=8, p=1)
+_CLAVE_PROCESO = os.urandom(32)  # Llave de los resúmenes rápidos en memoria (nunca se guarda)
+
+def _hash_clave(clave):
+    sal = os.urandom(16)
+    return f"{sal.hex()}${_scrypt(clave.encode(), salt=sal, **_SCRYPT).hex()}"
+
+def _verificar_clave(clave_b, guardado):
+    """True si la clave (ya en bytes) corresponde al hash guardado (scrypt o sha256 heredado)"""
+    if '$' in guardado:
+        sal, esperado = guardado.split('$', 1)
+        calculado = _scrypt(clave_b, salt=bytes.fromhex(sal), **_SCRYPT).hex()
+    else:
+        esperado, calculado = guardado, _sha256(clave_b).hexdigest()
+    # compare_digest: el tiempo de la comparación no revela cuántos caracteres coinciden
+    return hmac.compare_digest(calculado, esperado)
+
+def _resumen_rapido(clave_b):
+    return hmac.new(_CLAVE_PROCESO, clave_b, _sha256).digest()
+
+# Clave en la tabla configuracion -> campo en el diccionario de datos de la empresa
+_CLAVES_EMPRESA = {'emp_nombre': 'nombre', 'emp_nit': 'nit', 'emp_dir': 'dir', 'emp_tel': 'tel'}
+
+_LOGIN_CACHE_MAX = 1024
+
+_AUDIT_INTERVALO = 0.5  # segundos entre escrituras en lote de la auditoría
+_AUDIT_LOTE = 200       # registros pendientes que adelantan la escritura
+
 class SistemaSalonDB:
     def __init__(self, db_name="salon_sistema_pro.db"):
         self.db_name = db_name
+        self._local = threading.local()      # Conexión propia de cada hilo
+        self._conexiones = []                # [hilo dueño, conexión] de todas las abiertas
+        self._lock_conexiones = threading.Lock()
+        self._pid = os.getpid()              # Proceso dueño de las conexiones
+        self._wal_listo = False              # journal_mode=WAL ya aplicado al archivo
+        self._login_ok = {}                  # usuario -> (password_hash, resumen rápido de la clave)
+        self._cfg_cache = {}                 # 'campos' / 'empresa' -> diccionario ya leído; 'logo' -> logo.png ya leído (o None)
+        self._iniciar_auditoria()
+        atexit.register(self._vaciar_auditoria)  # Lo pendiente de auditoría se guarda al salir
         self.inicializar_tablas()
         self.migrar_db_a_iso() # Ejecuta la corrección de fechas automáticamente al iniciar
+        self.migrar_horas_hhmm()
 
     def conectar(self):
-        return sqlite3.connect(self.db_name)
+        """Retorna la conexión del hilo actual. Se abre una sola vez por hilo y se reutiliza,
+        así no se paga el costo de abrir el archivo y leer el esquema en cada consulta."""
+        if os.getpid() != self._pid:
+            self._descartar_heredadas()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._adoptar_conexion() or self._abrir_conexion()
+            self._local.conn = conn
+        return conn
+
+    def _adoptar_conexion(self):
+        """Los hilos del pool de FastAPI/anyio terminan tras un rato sin trabajo: la conexión
+        que dejó un hilo muerto se le pasa al hilo nuevo en vez de abrir otra (y su caché
+        de páginas sigue caliente)."""
+        actual = threading.current_thread()
+        with self._lock_conexiones:
+            for entrada in self._conexiones:
+                if not entrada[0].is_alive():
+                    entrada[0] = actual
+                    conn = entrada[1]
+                    break
+            else:
+                return None
+        if conn.in_transaction:
+            conn.rollback()  # Lo que el hilo anterior dejó a medias no se confirma
+        return conn
+
+    def _abrir_conexion(self):
+        # check_same_thread=False porque la conexión puede cambiar de hilo (ver _adoptar_conexion)
+        # y cerrar() la cierra desde otro; igual nunca la usan dos hilos a la vez
+        # cached_statements: la conexión vive todo el proceso, así que guarda más sentencias ya
+        # preparadas (por defecto 128) y las consultas repetidas no se vuelven a compilar
+        conn = sqlite3.connect(self.db_name, timeout=5, check_same_thread=False, cached_statements=256)
+        if not self._wal_listo:
+            # WAL: las lecturas no bloquean a las escrituras (y viceversa). Queda guardado en el
+            # archivo, así que basta con la primera conexión
+            modo = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+            if modo.lower() != "wal":
+                # Algunos sistemas de archivos (carpetas de red) no soportan WAL: SQLite sigue en su modo anterior
+                print(f"ADVERTENCIA: la base quedó en modo '{modo}', no WAL; lecturas y escrituras se bloquearán entre sí")
+            self._wal_listo = True
+        conn.executescript(_PRAGMAS_CONEXION)
+        with self._lock_conexiones:
+            self._conexiones.append([threading.current_thread(), conn])
+        return conn
+
+    def _descartar_heredadas(self):
+        """Tras un fork (varios workers) las conexiones del proceso padre no sirven aquí:
+        se olvidan sin cerrarlas (cerrarlas podría soltar bloqueos que son del padre)
+        y este proceso abre las suyas."""
+        with self._lock_conexiones:
+            if os.getpid() != self._pid:
+                self._conexiones = []
+                self._local = threading.local()
+                self._iniciar_auditoria()  # Lo pendiente es del padre: él lo guarda
+                self._pid = os.getpid()
+
+    def cerrar(self):
+        """Cierra todas las conexiones del pool (al apagar la aplicación)"""
+        self._detener_auditoria()
+        atexit.unregister(self._vaciar_auditoria)  # Ya se guardó todo; al salir no queda nada pendiente
+        with self._lock_conexiones:
+            for _, conn in self._conexiones:
+                try:
+                    # Actualiza las estadísticas del planificador con lo que se consultó
+                    conn.execute("PRAGMA optimize")
+                except sqlite3.Error:
+                    pass
+                conn.close()
+            self._conexiones.clear()
+            self._local = threading.local()
+
+    @contextmanager
+    def transaccion(self):
+        """Transacción de escritura explícita: BEGIN IMMEDIATE toma el bloqueo de escritura
+        al inicio y todo se confirma con un solo COMMIT (o se revierte si hay error).
+        Dentro del bloque usar la conexión entregada, no 'with self.conectar()',
+        porque la salida de ese 'with' haría COMMIT antes de tiempo."""
+        conn = self.conectar()
+        if conn.in_transaction:
+            # Ya hay una transacción abierta: participamos en ella
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
 
     # ==========================================
     #  HELPERS: TRADUCTORES DE FECHAS
     # ==========================================
-    def f_to_iso(self, fecha_ui):
-        """Convierte '21-12-25' (App) a '2025-12-21' (Base de Datos)"""
-        try:
-            return datetime.strptime(fecha_ui, "%d-%m-%y").strftime("%Y-%m-%d")
-        except:
-            return fecha_ui # Si falla, retorna original
-
-    def f_to_ui(self, fecha_iso):
-        """Convierte '2025-12-21' (Base de Datos) a '21-12-25' (App)"""
-        try:
-            return datetime.strptime(fecha_iso, "%Y-%m-%d").strftime("%d-%m-%y")
-        except:
-            return fecha_iso
+    # Funciones del módulo con caché: 'self' no entra en la llave de la caché
+    f_to_iso = staticmethod(_f_to_iso)
+    f_to_ui = staticmethod(_f_to_ui)
 
     # ==========================================
     #  INICIALIZACIÓN Y MIGRACIÓN
     # ==========================================
     def inicializar_tablas(self):
-        with self.conectar() as conn:
+        conn = self.conectar()
+        # Todo el DDL va en un solo script (un solo parseo) y, junto con la semilla,
+        # en una sola transacción de escritura
+        try:
+            conn.executescript("BEGIN IMMEDIATE;\n" + _ESQUEMA)
             c = conn.cursor()
-            
-            # --- NUEVA TABLA UNIFICADA DE TERCEROS ---
-            # Reemplaza a clientes, proveedores y profesionales individuales.
-            # Permite tener roles mixtos (Ej: Empleado que también es Cliente).
-            c.execute('''CREATE TABLE IF NOT EXISTS terceros (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                
-                -- Identificación y Nombres
-                doc_id TEXT UNIQUE,       -- Cédula, NIT o RUT
-                nombre1 TEXT,             -- Primer Nombre
-                nombre2 TEXT,             -- Segundo Nombre
-                apellido1 TEXT,           -- Primer Apellido
-                apellido2 TEXT,           -- Segundo Apellido
-                nombre_completo TEXT,     -- Campo calculado (Concatenación) para búsquedas rápidas
-                
-                -- Datos de Contacto
-                direccion TEXT,
-                telefono TEXT,
-                email TEXT,
-                ciudad TEXT,
-                fecha_nacimiento TEXT,
-                
-                -- ROLES (Banderas booleanas 0/1)
-                es_cliente INTEGER DEFAULT 0,
-                es_proveedor INTEGER DEFAULT 0,
-                es_empleado INTEGER DEFAULT 0,
-                
-                -- Datos Específicos de Empleado
-                comision REAL DEFAULT 0,
-                color_agenda TEXT,
-                servicios_asignados TEXT, -- "Corte,Tinte" o "TODOS"
-                
-                -- Metadatos
-                fecha_registro TEXT,
-                notas_internas TEXT
-            )''')
-
-            # --- MIGRACIÓN DE DATOS ANTIGUOS (SI EXISTEN) ---
-            # Si existían tablas viejas, idealmente aquí se haría un script de migración.
-            # Para este código, asumimos que si no existen las tablas viejas, usamos la nueva lógica.
-            # Mantenemos las definiciones viejas COMENTADAS o como respaldo si se requiere compatibilidad,
-            # pero el sistema ahora priorizará 'terceros'.
-            
-            # 1. Tablas Maestras de Configuración y Servicios
-            c.execute('''CREATE TABLE IF NOT EXISTS servicios (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, nombre TEXT UNIQUE, duracion_min INTEGER, precio REAL)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS medios_pago (nombre TEXT UNIQUE)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS configuracion (clave TEXT PRIMARY KEY, valor TEXT)''')
-            
-            # TABLA USUARIOS (LOGIN)
-            c.execute('''CREATE TABLE IF NOT EXISTS usuarios (
-                usuario TEXT PRIMARY KEY, 
-                password_hash TEXT, 
-                rol TEXT DEFAULT 'admin')''')
-
-            # --- TABLAS INVENTARIO ---
-            c.execute('''CREATE TABLE IF NOT EXISTS productos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                nombre TEXT UNIQUE, 
-                precio REAL, 
-                stock INTEGER,
-                codigo_barras TEXT)''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS ventas_productos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                cita_id INTEGER, 
-                producto_id INTEGER, 
-                cantidad INTEGER, 
-                precio_unitario REAL,
-                fecha TEXT,
-                FOREIGN KEY(cita_id) REFERENCES citas(id))''')
-
-            # --- TABLAS DE COMPRAS (Integradas con Terceros) ---
-            c.execute('''CREATE TABLE IF NOT EXISTS compras (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                proveedor_id INTEGER, -- Referencia a tabla terceros
-                fecha TEXT, 
-                total REAL, 
-                metodo_pago TEXT, 
-                estado TEXT, -- 'Pagado' o 'Pendiente'
-                observacion TEXT)''')
-
-            c.execute('''CREATE TABLE IF NOT EXISTS detalle_compras (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                compra_id INTEGER, 
-                producto_id INTEGER, 
-                cantidad INTEGER, 
-                costo_unitario REAL,
-                FOREIGN KEY(compra_id) REFERENCES compras(id))''')
-                
-            c.execute('''CREATE TABLE IF NOT EXISTS abonos_proveedores (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                compra_id INTEGER,
-                monto REAL,
-                fecha TEXT,
-                metodo TEXT)''')
-
-            # 2. Operativas (Citas referencia a Terceros)
-            c.execute('''CREATE TABLE IF NOT EXISTS citas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                cliente_id INTEGER,      -- Referencia a terceros (es_cliente=1)
-                profesional_id INTEGER,  -- Referencia a terceros (es_empleado=1)
-                servicio_id INTEGER,
-                fecha TEXT, hora_inicio TEXT, hora_fin TEXT, estado TEXT DEFAULT 'Pendiente', 
-                precio_final REAL, descuento REAL DEFAULT 0, nomina_pagada INTEGER DEFAULT 0)''')
-            
-            # 3. Financieras
-            c.execute('''CREATE TABLE IF NOT EXISTS pagos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, cita_id INTEGER, metodo TEXT, monto REAL, fecha TEXT, hora TEXT, descripcion_extra TEXT)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS gastos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, fecha TEXT, tipo TEXT, categoria TEXT, descripcion TEXT, metodo TEXT, valor REAL)''')
-            
-            # Prestamos (Referencia a Terceros Empleados)
-            c.execute('''CREATE TABLE IF NOT EXISTS prestamos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, profesional_id INTEGER, monto REAL, fecha TEXT, estado TEXT DEFAULT 'Pendiente', descripcion TEXT)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS abonos_prestamos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, prestamo_id INTEGER, valor REAL, fecha TEXT, descripcion TEXT, metodo TEXT)''')
-            
-            # 4. Control
-            c.execute('''CREATE TABLE IF NOT EXISTS bloqueos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, profesional_id INTEGER, fecha TEXT, hora_inicio TEXT, hora_fin TEXT, motivo TEXT)''')
-            
-            # 5. AUDITORÍA (Logs de seguridad)
-            c.execute('''CREATE TABLE IF NOT EXISTS auditoria (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                fecha TEXT,
-                hora TEXT,
-                accion TEXT,
-                detalle TEXT,
-                usuario TEXT DEFAULT 'Admin'
-            )''')
+            self._migrar_configuracion_sin_rowid(c)
+
+            # Búsqueda de texto de terceros (FTS5 por trigramas)
+            self._fts_terceros = self._crear_fts_terceros(c)
 
             # Semilla de Datos (Solo si la base está vacía)
+            # Un solo sondeo para las 4 tablas. Se revisa si están vacías (y no INSERT OR IGNORE)
+            # para no volver a crear lo que el usuario ya borró a propósito.
+            hay_pros, hay_servs, hay_medios, hay_usuarios = c.execute('''SELECT 
+                EXISTS(SELECT 1 FROM terceros WHERE es_empleado=1), EXISTS(SELECT 1 FROM servicios),
+                EXISTS(SELECT 1 FROM medios_pago), EXISTS(SELECT 1 FROM usuarios)''').fetchone()
             # Creamos empleados por defecto en la tabla TERCEROS si no existen
-            if c.execute("SELECT count(*) FROM terceros WHERE es_empleado=1").fetchone()[0] == 0:
+            if not hay_pros:
+                hoy = datetime.now().strftime("%Y-%m-%d")
                 c.execute('''INSERT INTO terceros (nombre_completo, nombre1, comision, servicios_asignados, es_empleado, fecha_registro) 
-                             VALUES ('Andrea', 'Andrea', 50, 'TODOS', 1, ?)''', (datetime.now().strftime("%Y-%m-%d"),))
+                             VALUES ('Andrea', 'Andrea', 50, 'TODOS', 1, ?)''', (hoy,))
                 c.execute('''INSERT INTO terceros (nombre_completo, nombre1, comision, servicios_asignados, es_empleado, fecha_registro) 
-                             VALUES ('Lennys', 'Lennys', 50, 'TODOS', 1, ?)''', (datetime.now().strftime("%Y-%m-%d"),))
+                             VALUES ('Lennys', 'Lennys', 50, 'TODOS', 1, ?)''', (hoy,))
 
-            if c.execute("SELECT count(*) FROM servicios").fetchone()[0] == 0:
+            if not hay_servs:
                 c.executemany("INSERT INTO servicios (nombre, duracion_min, precio) VALUES (?,?,?)", 
                              [('Cejas 3D', 60, 50000), ('Pestañas', 60, 80000), ('Diseño', 30, 30000)])
-            if c.execute("SELECT count(*) FROM medios_pago").fetchone()[0] == 0:
+            if not hay_medios:
                 c.executemany("INSERT INTO medios_pago (nombre) VALUES (?)", 
                              [('Efectivo',), ('Nequi',), ('Daviplata',), ('Tarjeta',), ('CREDITO',)])
             c.execute("INSERT OR IGNORE INTO configuracion (clave, valor) VALUES (?,?)", 
@@ -212,12 +484,55 @@ class SistemaSalonDB:
             except: pass
 
             # CREAR ADMIN POR DEFECTO SI NO EXISTE
-            if c.execute("SELECT count(*) FROM usuarios").fetchone()[0] == 0:
+            if not hay_usuarios:
                 # Contraseña por defecto: 1234
-                pass_defecto = hashlib.sha256("1234".encode()).hexdigest()
+                pass_defecto = _hash_clave("1234")
                 c.execute("INSERT INTO usuarios (usuario, password_hash) VALUES (?,?)", ("admin", pass_defecto))
 
             conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def _migrar_configuracion_sin_rowid(self, c):
+        """Bases creadas antes: pasa 'configuracion' a WITHOUT ROWID (una sola vez; la definición
+        de la tabla en sqlite_master indica si ya se hizo)"""
+        sql = c.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='configuracion'").fetchone()[0]
+        if 'WITHOUT ROWID' in sql.upper(): return
+        c.execute("CREATE TABLE configuracion_nueva (clave TEXT PRIMARY KEY NOT NULL, valor TEXT) WITHOUT ROWID")
+        c.execute("INSERT INTO configuracion_nueva (clave, valor) SELECT clave, valor FROM configuracion WHERE clave IS NOT NULL")
+        c.execute("DROP TABLE configuracion")
+        c.execute("ALTER TABLE configuracion_nueva RENAME TO configuracion")
+
+    def _crear_fts_terceros(self, c):
+        """Índice FTS5 (trigramas) sobre nombre, documento y teléfono de terceros, sincronizado
+        con triggers. Busca subcadenas como LIKE '%x%' pero sin recorrer toda la tabla.
+        Retorna False si este SQLite no trae FTS5 (entonces se sigue buscando con LIKE)."""
+        existe = c.execute("SELECT 1 FROM sqlite_master WHERE name='terceros_fts'").fetchone()
+        try:
+            c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS terceros_fts USING fts5(
+                         nombre_completo, doc_id, telefono,
+                         content='terceros', content_rowid='id', tokenize='trigram')""")
+        except sqlite3.OperationalError:
+            return False
+        c.execute("""CREATE TRIGGER IF NOT EXISTS terceros_fts_ai AFTER INSERT ON terceros BEGIN
+                         INSERT INTO terceros_fts(rowid, nombre_completo, doc_id, telefono)
+                         VALUES (new.id, new.nombre_completo, new.doc_id, new.telefono);
+                     END""")
+        c.execute("""CREATE TRIGGER IF NOT EXISTS terceros_fts_ad AFTER DELETE ON terceros BEGIN
+                         INSERT INTO terceros_fts(terceros_fts, rowid, nombre_completo, doc_id, telefono)
+                         VALUES ('delete', old.id, old.nombre_completo, old.doc_id, old.telefono);
+                     END""")
+        c.execute("""CREATE TRIGGER IF NOT EXISTS terceros_fts_au AFTER UPDATE OF nombre_completo, doc_id, telefono ON terceros BEGIN
+                         INSERT INTO terceros_fts(terceros_fts, rowid, nombre_completo, doc_id, telefono)
+                         VALUES ('delete', old.id, old.nombre_completo, old.doc_id, old.telefono);
+                         INSERT INTO terceros_fts(rowid, nombre_completo, doc_id, telefono)
+                         VALUES (new.id, new.nombre_completo, new.doc_id, new.telefono);
+                     END""")
+        if not existe:
+            # Primera vez: se indexan los terceros que ya estaban en la base
+            c.execute("INSERT INTO terceros_fts(terceros_fts) VALUES ('rebuild')")
+        return True
 
     def migrar_db_a_iso(self):
         """Revisa si hay fechas viejas (dd-mm-yy) y las pasa a (yyyy-mm-dd)"""
@@ -234,12 +549,31 @@ class SistemaSalonDB:
         }
         with self.conectar() as conn:
             c = conn.cursor()
+            # Ya migrada en un arranque anterior: una sola búsqueda por clave y listo
+            if c.execute("SELECT 1 FROM configuracion WHERE clave='schema_iso_migrated'").fetchone():
+                return
             for tabla, col in tablas_fechas.items():
                 try:
-                    sql_check = f"SELECT count(*) FROM {tabla} WHERE {col} LIKE '__-__-__'"
-                    if c.execute(sql_check).fetchone()[0] > 0:
-                        c.execute(f"UPDATE {tabla} SET {col} = '20'||substr({col},7,2)||'-'||substr({col},4,2)||'-'||substr({col},1,2) WHERE {col} LIKE '__-__-__' ")
+                    # Un solo recorrido por tabla: el UPDATE ya filtra las fechas viejas ('dd-mm-yy':
+                    # 8 caracteres con guiones en la 3ª y 6ª posición; más barato que el patrón LIKE)
+                    c.execute(f"UPDATE {tabla} SET {col} = '20'||substr({col},7,2)||'-'||substr({col},4,2)||'-'||substr({col},1,2) "
+                              f"WHERE length({col})=8 AND substr({col},3,1)='-' AND substr({col},6,1)='-'")
                 except: pass
+            c.execute("INSERT OR REPLACE INTO configuracion (clave, valor) VALUES ('schema_iso_migrated', '1')")
+            conn.commit()
+
+    def migrar_horas_hhmm(self):
+        """Rellena con ceros las horas viejas ('9:30' -> '09:30') de citas y bloqueos: los choques
+        de horario se buscan comparando las horas como texto"""
+        with self.conectar() as conn:
+            c = conn.cursor()
+            if c.execute("SELECT 1 FROM configuracion WHERE clave='horas_hhmm_migrated'").fetchone():
+                return
+            for tabla in ('citas', 'bloqueos'):
+                for col in ('hora_inicio', 'hora_fin'):
+                    c.execute(f"UPDATE {tabla} SET {col} = printf('%02d:%02d', CAST(substr({col},1,instr({col},':')-1) AS INTEGER), "
+                              f"CAST(substr({col},instr({col},':')+1) AS INTEGER)) WHERE instr({col},':') > 0 AND length({col}) != 5")
+            c.execute("INSERT OR REPLACE INTO configuracion (clave, valor) VALUES ('horas_hhmm_migrated', '1')")
             conn.commit()
 
     # ==========================================
@@ -285,29 +619,13 @@ class SistemaSalonDB:
             
             id_existente = datos.get('id')
             
+            # Sin id entra como nuevo; con id se actualiza esa fila (si ya no existe, no se crea otra)
             with self.conectar() as conn:
                 if id_existente:
-                    # UPDATE
-                    sql = '''UPDATE terceros SET 
-                             doc_id=?, nombre1=?, nombre2=?, apellido1=?, apellido2=?, nombre_completo=?,
-                             direccion=?, telefono=?, email=?, ciudad=?, 
-                             es_cliente=?, es_proveedor=?, es_empleado=?, 
-                             comision=?, color_agenda=?, servicios_asignados=?
-                             WHERE id=?'''
-                    # Nota: No actualizamos fecha_registro en update
-                    params = valores[:-1] + (id_existente,)
-                    conn.execute(sql, params)
-                    accion = f"Actualizado Tercero: {nombre_completo}"
+                    conn.execute(_SQL_UPDATE_TERCERO, valores[:-1] + (id_existente,))
                 else:
-                    # INSERT
-                    sql = '''INSERT INTO terceros (
-                             doc_id, nombre1, nombre2, apellido1, apellido2, nombre_completo,
-                             direccion, telefono, email, ciudad, 
-                             es_cliente, es_proveedor, es_empleado, 
-                             comision, color_agenda, servicios_asignados, fecha_registro)
-                             VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)'''
-                    conn.execute(sql, valores)
-                    accion = f"Creado Tercero: {nombre_completo}"
+                    conn.execute(_SQL_INSERT_TERCERO, valores)
+            accion = f"{'Actualizado' if id_existente else 'Creado'} Tercero: {nombre_completo}"
             
             self.registrar_auditoria("TERCEROS", accion)
             return True, "Datos guardados correctamente"
@@ -319,36 +637,61 @@ class SistemaSalonDB:
 
     def buscar_tercero_general(self, texto_busqueda):
         """Busca en la tabla terceros por nombre, documento o teléfono"""
-        filtro = f"%{texto_busqueda}%"
-        sql = '''SELECT * FROM terceros 
-                 WHERE nombre_completo LIKE ? OR doc_id LIKE ? OR telefono LIKE ?
-                 ORDER BY nombre_completo LIMIT 50'''
+        if self._fts_terceros and len(texto_busqueda) >= 3:
+            # El índice de trigramas encuentra la subcadena en cualquiera de las 3 columnas
+            sql = '''SELECT * FROM terceros 
+                     WHERE id IN (SELECT rowid FROM terceros_fts WHERE terceros_fts MATCH ?)
+                     ORDER BY nombre_completo LIMIT 50'''
+            params = (_frase_fts(texto_busqueda),)
+        else:
+            # Menos de 3 letras no forman un trigrama: se recorre la tabla con LIKE
+            filtro = f"%{texto_busqueda}%"
+            sql = '''SELECT * FROM terceros 
+                     WHERE nombre_completo LIKE ? OR doc_id LIKE ? OR telefono LIKE ?
+                     ORDER BY nombre_completo LIMIT 50'''
+            params = (filtro, filtro, filtro)
         with self.conectar() as conn:
-            conn.row_factory = sqlite3.Row # Para acceder por nombre de columna
-            return conn.execute(sql, (filtro, filtro, filtro)).fetchall()
+            cur = conn.cursor()
+            cur.row_factory = sqlite3.Row # Para acceder por nombre de columna
+            return cur.execute(sql, params).fetchall()
 
     def traer_tercero_por_id(self, id_tercero):
         with self.conectar() as conn:
-            conn.row_factory = sqlite3.Row
-            return conn.execute("SELECT * FROM terceros WHERE id=?", (id_tercero,)).fetchone()
+            cur = conn.cursor()
+            cur.row_factory = sqlite3.Row
+            return cur.execute("SELECT * FROM terceros WHERE id=?", (id_tercero,)).fetchone()
 
     # --- MÉTODOS DE COMPATIBILIDAD (Adaptados a la nueva estructura) ---
 
     def buscar_cliente(self, texto):
         """Usado en Agendar y Recepción. Busca solo si es_cliente=1"""
-        filtro = f"%{texto}%"
         with self.conectar() as conn:
-            # Retorna ID, Nombre, Telefono
-            res = conn.execute('''SELECT id, nombre_completo, telefono FROM terceros 
-                                  WHERE es_cliente=1 AND (nombre_completo LIKE ? OR telefono LIKE ? OR doc_id LIKE ?)''', 
-                                  (filtro, filtro, filtro)).fetchone()
-            return res
+            return self._buscar_cliente(conn, texto)
+
+    def _buscar_empleado(self, conn, nombre):
+        # Retorna (id,) del profesional con ese nombre (el más antiguo) o None.
+        # Se consulta siempre: otro proceso puede haber borrado o recreado al profesional
+        return conn.execute(_SQL_EMPLEADO_POR_NOMBRE, (nombre,)).fetchone()
+
+    def _buscar_cliente(self, conn, texto):
+        texto = str(texto)
+        # Retorna ID, Nombre, Telefono (el cliente más antiguo que coincida)
+        if self._fts_terceros and len(texto) >= 3:
+            # Un solo sondeo al índice de trigramas en vez de 3 LIKE '%x%' sobre la tabla
+            return conn.execute('''SELECT id, nombre_completo, telefono FROM terceros 
+                                   WHERE es_cliente=1 AND id IN (SELECT rowid FROM terceros_fts WHERE terceros_fts MATCH ?)
+                                   ORDER BY id LIMIT 1''', (_frase_fts(texto),)).fetchone()
+        filtro = f"%{texto}%"
+        return conn.execute('''SELECT id, nombre_completo, telefono FROM terceros 
+                               WHERE es_cliente=1 AND (nombre_completo LIKE ? OR telefono LIKE ? OR doc_id LIKE ?)
+                               ORDER BY id LIMIT 1''', 
+                               (filtro, filtro, filtro)).fetchone()
 
     def get_listas(self):
         """Retorna lista de Nombres de Empleados y Servicios"""
         with self.conectar() as conn:
             # Profesionales: es_empleado = 1
-            pros = [x[0] for x in conn.execute("SELECT nombre_completo FROM terceros WHERE es_empleado=1").fetchall()]
+            pros = [x[0] for x in conn.execute("SELECT nombre_completo FROM terceros WHERE es_empleado=1 ORDER BY id").fetchall()]
             servs = [x[0] for x in conn.execute("SELECT nombre FROM servicios").fetchall()]
         return pros, servs
 
@@ -364,11 +707,10 @@ class SistemaSalonDB:
                 return conn.execute("SELECT nombre, duracion_min, precio FROM servicios").fetchall()
             elif tipo == 'profesionales':
                 # Ahora leemos de terceros con flag empleado
-                return conn.execute("SELECT nombre_completo, comision, servicios_asignados FROM terceros WHERE es_empleado=1").fetchall()
+                return conn.execute("SELECT nombre_completo, comision, servicios_asignados FROM terceros WHERE es_empleado=1 ORDER BY id").fetchall()
             elif tipo == 'clientes':
                 # Ahora leemos de terceros con flag cliente
-                rows = conn.execute("SELECT id, nombre_completo, telefono, fecha_registro FROM terceros WHERE es_cliente=1 ORDER BY id DESC LIMIT 100").fetchall()
-                return [(r[0], r[1], r[2], self.f_to_ui(r[3])) for r in rows]
+                return conn.execute(f"SELECT id, nombre_completo, telefono, {_sql_f_ui('fecha_registro')} FROM terceros WHERE es_cliente=1 ORDER BY id DESC LIMIT 100").fetchall()
         return []
 
     # ==========================================
@@ -380,15 +722,20 @@ class SistemaSalonDB:
             json_val = json.dumps(dict_campos)
             with self.conectar() as conn:
                 conn.execute("INSERT OR REPLACE INTO configuracion (clave, valor) VALUES (?,?)", ('campos_obligatorios', json_val))
+            self._cfg_cache.pop('campos', None)
             return True, "Configuración actualizada"
         except Exception as e: return False, str(e)
 
     def traer_config_campos(self):
         """Retorna diccionario con booleanos de campos obligatorios"""
+        # Se lee en cada formulario pero casi nunca cambia: queda en memoria hasta que se guarde
+        if 'campos' in self._cfg_cache: return dict(self._cfg_cache['campos'])
         try:
             with self.conectar() as conn:
                 res = conn.execute("SELECT valor FROM configuracion WHERE clave='campos_obligatorios'").fetchone()
-                if res: return json.loads(res[0])
+                if res:
+                    self._cfg_cache['campos'] = json.loads(res[0])
+                    return dict(self._cfg_cache['campos'])
         except: pass
         # Valor por defecto
         return {"doc_id": True, "telefono": False, "email": False, "direccion": False}
@@ -396,32 +743,102 @@ class SistemaSalonDB:
     # ==========================================
     #  SISTEMA DE AUDITORÍA
     # ==========================================
+    # Los registros no se escriben en cada acción: se acumulan en memoria y un hilo de fondo
+    # los guarda en lote (una transacción) _AUDIT_INTERVALO segundos después del primero pendiente
+    # o al juntar _AUDIT_LOTE. Sin registros pendientes el hilo no despierta.
+    def _iniciar_auditoria(self):
+        self._audit_pend = []                 # (fecha, hora, accion, detalle) por guardar
+        self._lock_audit = threading.Lock()   # Protege _audit_pend
+        self._lock_audit_escritura = threading.Lock()  # Un solo lote escribiéndose a la vez
+        self._audit_hay = threading.Event()   # Llegó algo a _audit_pend
+        self._audit_ya = threading.Event()    # Guardar sin esperar el intervalo (lote lleno o cierre)
+        self._audit_hilo = None
+
     def registrar_auditoria(self, accion, detalle):
-        try:
-            with self.conectar() as conn:
-                conn.execute("INSERT INTO auditoria (fecha, hora, accion, detalle) VALUES (?,?,?,?)", 
-                             (datetime.now().strftime("%Y-%m-%d"), datetime.now().strftime("%H:%M:%S"), accion, detalle))
-        except Exception as e:
-            print(f"Error Audit: {e}")
+        if os.getpid() != self._pid:
+            self._descartar_heredadas()
+        ahora = datetime.now()
+        with self._lock_audit:
+            self._audit_pend.append((ahora.strftime("%Y-%m-%d"), ahora.strftime("%H:%M:%S"), accion, detalle))
+            lleno = len(self._audit_pend) >= _AUDIT_LOTE
+            if self._audit_hilo is None:
+                self._audit_hilo = threading.Thread(target=self._ciclo_auditoria, name="auditoria", daemon=True)
+                self._audit_hilo.start()
+        self._audit_hay.set()
+        if lleno: self._audit_ya.set()
+
+    def _ciclo_auditoria(self):
+        # Sin registros el hilo duerme; con el primero espera _AUDIT_INTERVALO para juntar el lote
+        while self._audit_hilo is threading.current_thread():
+            self._audit_hay.wait()
+            self._audit_ya.wait(_AUDIT_INTERVALO)
+            self._audit_hay.clear(); self._audit_ya.clear()
+            self._vaciar_auditoria()
+
+    def _vaciar_auditoria(self):
+        """Guarda en la base todo lo pendiente de auditoría (en una sola transacción)"""
+        if os.getpid() != self._pid:
+            self._descartar_heredadas()
+        with self._lock_audit_escritura:
+            with self._lock_audit:
+                lote, self._audit_pend = self._audit_pend, []
+            if not lote: return
+            try:
+                with self.transaccion() as conn:
+                    conn.executemany("INSERT INTO auditoria (fecha, hora, accion, detalle) VALUES (?,?,?,?)", lote)
+            except Exception as e:
+                print(f"Error Audit: {e}")
+
+    def _detener_auditoria(self):
+        with self._lock_audit:
+            hilo, self._audit_hilo = self._audit_hilo, None
+        if hilo is not None:
+            self._audit_hay.set(); self._audit_ya.set()
+            hilo.join()
+        self._vaciar_auditoria()
 
     def traer_auditoria(self):
+        self._vaciar_auditoria()  # Que se vea también lo que aún estaba en memoria
         with self.conectar() as conn:
-            rows = conn.execute("SELECT fecha, hora, accion, detalle, usuario FROM auditoria ORDER BY id DESC LIMIT 100").fetchall()
-            return [(self.f_to_ui(r[0]), r[1], r[2], r[3], r[4]) for r in rows]
+            return conn.execute(f"SELECT {_sql_f_ui('fecha')}, hora, accion, detalle, usuario FROM auditoria ORDER BY id DESC LIMIT 100").fetchall()
 
     # ==========================================
     #  SEGURIDAD Y BACKUP
     # ==========================================
-    def validar_login(self, usuario, password_texto):
-        pass_hash = hashlib.sha256(password_texto.encode()).hexdigest()
+    def _hash_guardado(self, usuario):
+        """Hash de la clave de 'usuario' (o None). Se lee siempre de la tabla: otro proceso
+        (otro worker o la app de escritorio) puede haber cambiado la clave o borrado el usuario"""
         with self.conectar() as conn:
-            data = conn.execute("SELECT usuario FROM usuarios WHERE usuario=? AND password_hash=?", (usuario, pass_hash)).fetchone()
-            if data:
-                self.registrar_auditoria("LOGIN", f"Ingreso exitoso: {usuario}")
-                return True
+            fila = conn.execute("SELECT password_hash FROM usuarios WHERE usuario=?", (usuario,)).fetchone()
+        return fila[0] if fila else None
+
+    def validar_login(self, usuario, password_texto):
+        guardado = self._hash_guardado(usuario)
+        if guardado is None:
+            ok = False
+        else:
+            # Reingreso con la misma clave ya verificada: se compara un resumen HMAC
+            # en vez de repetir scrypt (en memoria nunca queda la clave en texto plano)
+            clave_b = password_texto.encode()  # Se codifica una sola vez para todo el chequeo
+            rapido = _resumen_rapido(clave_b)
+            previo = self._login_ok.get(usuario)
+            if previo and previo[0] == guardado and hmac.compare_digest(previo[1], rapido):
+                ok = True
             else:
-                self.registrar_auditoria("LOGIN_FAIL", f"Intento fallido: {usuario}")
-                return False
+                ok = _verificar_clave(clave_b, guardado)
+                if ok:
+                    if '$' not in guardado:
+                        # Clave heredada en sha256: se guarda ya con scrypt
+                        guardado = self._actualizar_clave(usuario, password_texto)
+                    if len(self._login_ok) >= _LOGIN_CACHE_MAX:
+                        self._login_ok.clear()
+                    self._login_ok[usuario] = (guardado, rapido)
+        if ok:
+            self.registrar_auditoria("LOGIN", f"Ingreso exitoso: {usuario}")
+            return True
+        else:
+            self.registrar_auditoria("LOGIN_FAIL", f"Intento fallido: {usuario}")
+            return False
 
     def generar_backup_db(self, carpeta_destino):
         try:
@@ -430,17 +847,28 @@ class SistemaSalonDB:
             timestamp = datetime.now().strftime("%Y_%m_%d_%H%M%S")
             nombre_backup = f"RESPALDO_SALON_{timestamp}.db"
             ruta_completa = os.path.join(carpeta_destino, nombre_backup)
-            shutil.copy2(self.db_name, ruta_completa)
+            # API de respaldo de SQLite: copia página a página una foto consistente de la base
+            # (incluye lo que aún está en el archivo WAL) sin frenar a las demás conexiones
+            destino = sqlite3.connect(ruta_completa)
+            try:
+                self.conectar().backup(destino, pages=1000, sleep=0.05)
+            finally:
+                destino.close()
             self.registrar_auditoria("BACKUP", f"Copia creada: {nombre_backup}")
             return True, f"Respaldo creado correctamente en:\n{ruta_completa}"
         except Exception as e:
             return False, f"Error al crear respaldo: {str(e)}"
 
+    def _actualizar_clave(self, usuario, clave):
+        nuevo_hash = _hash_clave(clave)
+        with self.conectar() as conn:
+            conn.execute("UPDATE usuarios SET password_hash=? WHERE usuario=?", (nuevo_hash, usuario))
+        self._login_ok.pop(usuario, None)
+        return nuevo_hash
+
     def cambiar_clave_usuario(self, usuario, nueva_clave):
         try:
-            nuevo_hash = hashlib.sha256(nueva_clave.encode()).hexdigest()
-            with self.conectar() as conn:
-                conn.execute("UPDATE usuarios SET password_hash=? WHERE usuario=?", (nuevo_hash, usuario))
+            self._actualizar_clave(usuario, nueva_clave)
             self.registrar_auditoria("CAMBIO_CLAVE", f"Usuario {usuario} cambió su clave")
             return True, "Clave actualizada"
         except Exception as e: return False, str(e)
@@ -451,15 +879,15 @@ class SistemaSalonDB:
     def guardar_datos_empresa(self, nombre, nit, direccion, telefono, ruta_logo_origen=None):
         try:
             with self.conectar() as conn:
-                # Guardamos los datos de texto en la tabla configuracion
-                conn.execute("INSERT OR REPLACE INTO configuracion (clave, valor) VALUES ('emp_nombre', ?)", (nombre,))
-                conn.execute("INSERT OR REPLACE INTO configuracion (clave, valor) VALUES ('emp_nit', ?)", (nit,))
-                conn.execute("INSERT OR REPLACE INTO configuracion (clave, valor) VALUES ('emp_dir', ?)", (direccion,))
-                conn.execute("INSERT OR REPLACE INTO configuracion (clave, valor) VALUES ('emp_tel', ?)", (telefono,))
+                # Guardamos los datos de texto en la tabla configuracion (una sentencia, 4 filas)
+                conn.executemany("INSERT OR REPLACE INTO configuracion (clave, valor) VALUES (?,?)",
+                                 [('emp_nombre', nombre), ('emp_nit', nit), ('emp_dir', direccion), ('emp_tel', telefono)])
+            self._cfg_cache.pop('empresa', None)
             
             # Gestionar el logo (copiar archivo)
             if ruta_logo_origen and os.path.exists(ruta_logo_origen):
                 shutil.copy2(ruta_logo_origen, "logo.png")
+                self._cfg_cache.pop('logo', None)
                 
             self.registrar_auditoria("CONFIG_EMPRESA", "Se actualizaron datos de la empresa")
             return True, "Datos y Logo guardados correctamente"
@@ -468,15 +896,15 @@ class SistemaSalonDB:
 
     def traer_datos_empresa(self):
         """Retorna un diccionario con los datos, o vacíos si no existen"""
+        if 'empresa' in self._cfg_cache: return dict(self._cfg_cache['empresa'])
         datos = {'nombre': 'MI SALÓN DE BELLEZA', 'nit': '', 'dir': '', 'tel': ''}
         try:
             with self.conectar() as conn:
-                rows = conn.execute("SELECT clave, valor FROM configuracion WHERE clave LIKE 'emp_%'").fetchall()
-                for k, v in rows:
-                    if k == 'emp_nombre': datos['nombre'] = v
-                    elif k == 'emp_nit': datos['nit'] = v
-                    elif k == 'emp_dir': datos['dir'] = v
-                    elif k == 'emp_tel': datos['tel'] = v
+                # Las 4 claves se buscan directo por la llave primaria
+                rows = conn.execute(f"SELECT clave, valor FROM configuracion WHERE clave IN ({','.join('?' * len(_CLAVES_EMPRESA))})",
+                                    tuple(_CLAVES_EMPRESA)).fetchall()
+            datos.update({_CLAVES_EMPRESA[k]: v for k, v in rows})
+            self._cfg_cache['empresa'] = dict(datos)
         except: pass
         return datos
 
@@ -558,7 +986,7 @@ class SistemaSalonDB:
 
             if metodo_pago != "CREDITO":
                 desc_gasto = f"Compra ID:{id_compra} Prov:{id_prov}"
-                c.execute("INSERT INTO gastos (fecha, tipo, categoria, descripcion, metodo, valor) VALUES (?,?,?,?,?,?)",
+                c.execute(_SQL_INSERT_GASTO,
                           (hoy_iso, "COSTO", "Compra Mercancia", desc_gasto, metodo_pago, total))
             
             conn.commit()
@@ -566,58 +994,50 @@ class SistemaSalonDB:
         except Exception as e:
             conn.rollback()
             return False, str(e)
-        finally:
-            conn.close()
 
     def traer_cuentas_por_pagar_proveedores(self):
+        # El saldo se calcula y filtra en SQL: solo llegan las compras que aún se deben
         sql = '''
-        SELECT c.id, t.nombre_completo, c.fecha, c.total, 
-               (SELECT IFNULL(SUM(monto),0) FROM abonos_proveedores WHERE compra_id = c.id) as pagado
-        FROM compras c 
-        JOIN terceros t ON c.proveedor_id = t.id 
-        WHERE c.metodo_pago = 'CREDITO' AND c.estado = 'Pendiente'
+        SELECT id, nombre_completo, fecha, total, total - pagado AS saldo FROM (
+            SELECT c.id, t.nombre_completo, c.fecha, c.total, 
+                   (SELECT IFNULL(SUM(monto),0) FROM abonos_proveedores WHERE compra_id = c.id) as pagado
+            FROM compras c 
+            JOIN terceros t ON c.proveedor_id = t.id 
+            WHERE c.metodo_pago = 'CREDITO' AND c.estado = 'Pendiente'
+        )
+        WHERE total - pagado > 0
+        ORDER BY id
         '''
-        data = []
+        # El formato de moneda queda solo para la vista (se recorre el cursor, sin lista intermedia)
         with self.conectar() as conn:
-            rows = conn.execute(sql).fetchall()
-            for r in rows:
-                id_c, nom, fec, tot, pagado = r
-                saldo = tot - pagado
-                if saldo > 0:
-                    data.append((id_c, self.f_to_ui(fec), nom, f"${tot:,.0f}", f"${saldo:,.0f}"))
-        return data
+            return [(id_c, self.f_to_ui(fec), nom, f"${tot:,.0f}", f"${saldo:,.0f}") for id_c, nom, fec, tot, saldo in conn.execute(sql)]
 
     def abonar_proveedor(self, id_compra, monto, metodo):
         hoy_iso = datetime.now().strftime("%Y-%m-%d")
-        conn = self.conectar()
         try:
-            c = conn.cursor()
-            c.execute("INSERT INTO abonos_proveedores (compra_id, monto, fecha, metodo) VALUES (?,?,?,?)",
-                      (id_compra, monto, hoy_iso, metodo))
-            c.execute("INSERT INTO gastos (fecha, tipo, categoria, descripcion, metodo, valor) VALUES (?,?,?,?,?,?)",
-                          (hoy_iso, "GASTO", "Pago Proveedor", f"Abono Compra #{id_compra}", metodo, monto))
-            row = c.execute("SELECT total FROM compras WHERE id=?", (id_compra,)).fetchone()
-            total_orig = row[0]
-            pagado = c.execute("SELECT SUM(monto) FROM abonos_proveedores WHERE compra_id=?", (id_compra,)).fetchone()[0]
-            if pagado >= total_orig:
-                c.execute("UPDATE compras SET estado='Pagado' WHERE id=?", (id_compra,))
-            conn.commit()
+            with self.transaccion() as conn:
+                c = conn.cursor()
+                c.execute("INSERT INTO abonos_proveedores (compra_id, monto, fecha, metodo) VALUES (?,?,?,?)",
+                          (id_compra, monto, hoy_iso, metodo))
+                c.execute(_SQL_INSERT_GASTO,
+                              (hoy_iso, "GASTO", "Pago Proveedor", f"Abono Compra #{id_compra}", metodo, monto))
+                # Un solo UPDATE decide si la compra quedó saldada (la suma sale del índice compra_id, monto)
+                if not c.execute('''UPDATE compras SET estado = CASE WHEN total <= (SELECT COALESCE(SUM(monto), 0) FROM abonos_proveedores WHERE compra_id=?)
+                                                             THEN 'Pagado' ELSE estado END
+                                    WHERE id=? RETURNING id''', (id_compra, id_compra)).fetchone():
+                    raise Exception(f"No existe la compra #{id_compra}")
             return True, "Abono registrado correctamente"
         except Exception as e:
-            conn.rollback()
             return False, str(e)
-        finally:
-            conn.close()
 
     def traer_reporte_compras(self, f1, f2):
         d1 = self.f_to_iso(f1); d2 = self.f_to_iso(f2)
         # JOIN con terceros
-        sql = '''SELECT c.id, c.fecha, t.nombre_completo, c.total, c.metodo_pago, c.estado 
-                 FROM compras c JOIN terceros t ON c.proveedor_id = t.id
-                 WHERE c.fecha BETWEEN ? AND ? ORDER BY c.fecha DESC'''
+        sql = f'''SELECT c.id, {_sql_f_ui('c.fecha')}, t.nombre_completo, c.total, c.metodo_pago, c.estado 
+                  FROM compras c JOIN terceros t ON c.proveedor_id = t.id
+                  WHERE c.fecha BETWEEN ? AND ? ORDER BY c.fecha DESC'''
         with self.conectar() as conn:
-            rows = conn.execute(sql, (d1, d2)).fetchall()
-            return [(r[0], self.f_to_ui(r[1]), r[2], r[3], r[4], r[5]) for r in rows]
+            return conn.execute(sql, (d1, d2)).fetchall()
 
     # ==========================================
     #  MÓDULO FINANCIERO (ADAPTADO A TERCEROS)
@@ -626,149 +1046,140 @@ class SistemaSalonDB:
         if productos_carrito is None: productos_carrito = []
         ids = ids_str.split(',')
         id_principal = ids[0]
-        conn = self.conectar()
-        hoy_iso = datetime.now().strftime("%Y-%m-%d")
+        ahora = datetime.now()  # Un solo instante para todo el cobro
+        hoy_iso, hora = ahora.strftime("%Y-%m-%d"), ahora.strftime("%H:%M")
         try:
-            c = conn.cursor()
-            for i in ids: 
-                c.execute("UPDATE citas SET estado='Pagado', precio_final = (SELECT precio_final FROM citas WHERE id=?) WHERE id=?", (i, i))
+            with self.transaccion() as conn:
+                c = conn.cursor()
+                # Todas las citas del cobro en un solo UPDATE
+                c.execute(f"UPDATE citas SET estado='Pagado' WHERE id IN ({','.join('?' * len(ids))})", ids)
             
-            for prod_id, nom, cant, total, unit in productos_carrito:
-                curr = c.execute("SELECT stock FROM productos WHERE id=?", (prod_id,)).fetchone()
-                if curr and curr[0] >= cant:
-                    nuevo_stock = curr[0] - cant
-                    c.execute("UPDATE productos SET stock=? WHERE id=?", (nuevo_stock, prod_id))
-                else:
-                    raise Exception(f"Stock insuficiente para el producto: {nom}")
-                c.execute('''INSERT INTO ventas_productos (cita_id, producto_id, cantidad, precio_unitario, fecha) 
-                             VALUES (?,?,?,?,?)''', (id_principal, prod_id, cant, unit, hoy_iso))
-
-            for m, v in pagos:
-                if v > 0: 
-                    desc_pago = "Venta Servicios"
-                    if len(productos_carrito) > 0: desc_pago += " + Productos"
-                    c.execute("INSERT INTO pagos (cita_id, metodo, monto, fecha, hora, descripcion_extra) VALUES (?,?,?,?,?,?)", 
-                             (id_principal, m, v, hoy_iso, datetime.now().strftime("%H:%M"), desc_pago))
+                if productos_carrito:
+                    # Stock de todos los productos del carrito en una sola consulta; se valida en memoria
+                    # en el mismo orden del carrito (un producto repetido descuenta de lo que ya quedó)
+                    # Ids como int: desde el Treeview llegan como texto ('1') y las claves del dict son int
+                    carrito = [(int(prod_id), nom, cant, unit) for prod_id, nom, cant, _, unit in productos_carrito]
+                    prod_ids = list({p[0] for p in carrito})
+                    stocks = dict(c.execute(f"SELECT id, stock FROM productos WHERE id IN ({','.join('?' * len(prod_ids))})", prod_ids).fetchall())
+                    for prod_id, nom, cant, _ in carrito:
+                        if stocks.get(prod_id) is not None and stocks[prod_id] >= cant:
+                            stocks[prod_id] -= cant
+                        else:
+                            raise Exception(f"Stock insuficiente para el producto: {nom}")
+                    c.executemany("UPDATE productos SET stock = stock - ? WHERE id=?", [(cant, prod_id) for prod_id, _, cant, _ in carrito])
+                    c.executemany('''INSERT INTO ventas_productos (cita_id, producto_id, cantidad, precio_unitario, fecha) 
+                                     VALUES (?,?,?,?,?)''', [(id_principal, prod_id, cant, unit, hoy_iso) for prod_id, _, cant, unit in carrito])
+
+                for m, v in pagos:
+                    if v > 0: 
+                        desc_pago = "Venta Servicios"
+                        if len(productos_carrito) > 0: desc_pago += " + Productos"
+                        c.execute(_SQL_INSERT_PAGO, 
+                                 (id_principal, m, v, hoy_iso, hora, desc_pago))
             
-            if descuento_dinero > 0:
-                c.execute("INSERT INTO gastos (fecha, tipo, categoria, descripcion, metodo, valor) VALUES (?,?,?,?,?,?)", 
-                         (hoy_iso, "GASTO", "Descuento Ventas", f"Descuento a {cliente_nombre}", "Cruce Contable", descuento_dinero))
+                if descuento_dinero > 0:
+                    c.execute(_SQL_INSERT_GASTO, 
+                             (hoy_iso, "GASTO", "Descuento Ventas", f"Descuento a {cliente_nombre}", "Cruce Contable", descuento_dinero))
             
-            conn.commit()
             return True, "Venta Registrada Correctamente"
         except Exception as e:
-            conn.rollback()
             return False, f"Error al procesar cobro: {str(e)}"
-        finally:
-            conn.close()
 
     def saldar_cuenta_por_cobrar(self, id_pago, nuevo_metodo):
-        conn = self.conectar()
         try:
-            c = conn.cursor()
-            c.execute("UPDATE pagos SET metodo=?, fecha=?, hora=? WHERE id=?", 
-                      (nuevo_metodo, datetime.now().strftime("%Y-%m-%d"), datetime.now().strftime("%H:%M"), id_pago))
-            conn.commit()
+            with self.transaccion() as conn:
+                c = conn.cursor()
+                ahora = datetime.now()
+                c.execute("UPDATE pagos SET metodo=?, fecha=?, hora=? WHERE id=?", 
+                          (nuevo_metodo, ahora.strftime("%Y-%m-%d"), ahora.strftime("%H:%M"), id_pago))
             return True, "Deuda Saldada"
         except Exception as e:
-            conn.rollback()
             return False, str(e)
-        finally:
-            conn.close()
 
     def realizar_abono_deuda(self, tipo_deuda, id_registro, monto_abono, metodo_pago):
-        conn = self.conectar()
-        hoy_iso = datetime.now().strftime("%Y-%m-%d")
+        ahora = datetime.now()
+        hoy_iso, hora = ahora.strftime("%Y-%m-%d"), ahora.strftime("%H:%M")
         try:
-            c = conn.cursor()
-            if tipo_deuda == 'CLIENTE':
-                deuda = c.execute("SELECT monto, cita_id FROM pagos WHERE id=?", (id_registro,)).fetchone()
-                if not deuda: return False, "No existe"
-                monto_deuda, cita_id = deuda
+            with self.transaccion() as conn:
+                c = conn.cursor()
+                if tipo_deuda == 'CLIENTE':
+                    # Abono parcial: se descuenta y se lee el saldo en la misma sentencia (sin SELECT previo)
+                    deuda = c.execute("UPDATE pagos SET monto = monto - ? WHERE id=? AND monto > ? RETURNING monto, cita_id",
+                                      (monto_abono, id_registro, monto_abono)).fetchone()
+                    if deuda:
+                        nuevo_saldo, cita_id = deuda
+                        c.execute(_SQL_INSERT_PAGO,
+                                        (cita_id, metodo_pago, monto_abono, hoy_iso, hora, "Abono Crédito"))
+                        return True, f"Abono OK. Restan: ${nuevo_saldo:,.0f}"
                 
-                if monto_abono >= monto_deuda:
-                    c.execute("DELETE FROM pagos WHERE id=?", (id_registro,))
-                    c.execute("INSERT INTO pagos (cita_id, metodo, monto, fecha, hora, descripcion_extra) VALUES (?,?,?,?,?,?)",
-                                    (cita_id, metodo_pago, monto_deuda, hoy_iso, datetime.now().strftime("%H:%M"), "Pago Deuda Crédito"))
-                    conn.commit()
+                    # El abono cubre toda la deuda (o no existe): se borra el crédito devolviendo su monto
+                    deuda = c.execute("DELETE FROM pagos WHERE id=? RETURNING monto, cita_id", (id_registro,)).fetchone()
+                    if not deuda:
+                        return False, "No existe"
+                    monto_deuda, cita_id = deuda
+                    c.execute(_SQL_INSERT_PAGO,
+                                    (cita_id, metodo_pago, monto_deuda, hoy_iso, hora, "Pago Deuda Crédito"))
                     return True, "Saldado Total"
-                else:
-                    nuevo_saldo = monto_deuda - monto_abono
-                    c.execute("UPDATE pagos SET monto=? WHERE id=?", (nuevo_saldo, id_registro))
-                    c.execute("INSERT INTO pagos (cita_id, metodo, monto, fecha, hora, descripcion_extra) VALUES (?,?,?,?,?,?)",
-                                    (cita_id, metodo_pago, monto_abono, hoy_iso, datetime.now().strftime("%H:%M"), "Abono Crédito"))
-                    conn.commit()
-                    return True, f"Abono OK. Restan: ${nuevo_saldo:,.0f}"
-
-            elif tipo_deuda == 'PROFESIONAL':
-                prestamo = c.execute("SELECT monto FROM prestamos WHERE id=?", (id_registro,)).fetchone()
-                if not prestamo: return False, "No encontrado"
-                monto_prestamo = prestamo[0]
-                
-                c.execute("INSERT INTO abonos_prestamos (prestamo_id, valor, fecha, descripcion, metodo) VALUES (?,?,?,?,?)",
-                                (id_registro, monto_abono, hoy_iso, "Abono Voluntario", metodo_pago))
-                
-                nuevo_saldo = monto_prestamo - monto_abono
-                estado = 'Pagado' if nuevo_saldo <= 0 else 'Pendiente'
-                monto_final = 0 if nuevo_saldo <= 0 else nuevo_saldo
+
+                elif tipo_deuda == 'PROFESIONAL':
+                    # Saldo y estado se calculan en el mismo UPDATE (las expresiones ven el monto anterior)
+                    prestamo = c.execute('''UPDATE prestamos SET monto = MAX(monto - ?, 0),
+                                             estado = CASE WHEN monto - ? <= 0 THEN 'Pagado' ELSE 'Pendiente' END
+                                             WHERE id=? RETURNING id''', (monto_abono, monto_abono, id_registro)).fetchone()
+                    if not prestamo:
+                        return False, "No encontrado"
                 
-                c.execute("UPDATE prestamos SET monto=?, estado=? WHERE id=?", (monto_final, estado, id_registro))
-                conn.commit()
-                return True, "Abono Registrado"
+                    c.execute("INSERT INTO abonos_prestamos (prestamo_id, valor, fecha, descripcion, metodo) VALUES (?,?,?,?,?)",
+                                    (id_registro, monto_abono, hoy_iso, "Abono Voluntario", metodo_pago))
+                    return True, "Abono Registrado"
 
         except Exception as e:
-            conn.rollback()
             return False, str(e)
-        finally:
-            conn.close()
 
     def pagar_nomina_flexible(self, ids_citas, abono_prestamos, lista_pagos_nomina, profesional_nombre):
-        conn = self.conectar()
         hoy_iso = datetime.now().strftime("%Y-%m-%d")
         try:
-            cursor = conn.cursor()
-            # Buscar ID de empleado en terceros
-            pid = cursor.execute("SELECT id FROM terceros WHERE nombre_completo=? AND es_empleado=1", (profesional_nombre,)).fetchone()[0]
+            with self.transaccion() as conn:
+                cursor = conn.cursor()
+                # Buscar ID de empleado en terceros
+                pid = self._buscar_empleado(cursor, profesional_nombre)[0]
             
-            for ic in ids_citas: 
-                cursor.execute("UPDATE citas SET nomina_pagada = 1 WHERE id = ?", (ic,))
+                if ids_citas:
+                    cursor.execute(f"UPDATE citas SET nomina_pagada = 1 WHERE id IN ({','.join('?' * len(ids_citas))})", list(ids_citas))
             
-            if abono_prestamos > 0:
-                prestamos = cursor.execute("SELECT id, monto FROM prestamos WHERE profesional_id=? AND estado='Pendiente' ORDER BY id ASC", (pid,)).fetchall()
-                remanente = abono_prestamos
-                for pid_p, monto_orig in prestamos:
-                    if remanente <= 0: break
-                    abono_real = 0
-                    if remanente >= monto_orig:
-                        cursor.execute("UPDATE prestamos SET estado='Pagado', monto=0 WHERE id=?", (pid_p,))
-                        abono_real = monto_orig
-                        remanente -= monto_orig
-                    else:
-                        cursor.execute("UPDATE prestamos SET monto=? WHERE id=?", (monto_orig - remanente, pid_p))
-                        abono_real = remanente
-                        remanente = 0
-                    cursor.execute("INSERT INTO abonos_prestamos (prestamo_id, valor, fecha, descripcion) VALUES (?,?,?,?)", 
-                                  (pid_p, abono_real, hoy_iso, "Deducción Nómina"))
+                if abono_prestamos > 0:
+                    prestamos = cursor.execute("SELECT id, monto FROM prestamos WHERE profesional_id=? AND estado='Pendiente' ORDER BY id ASC", (pid,)).fetchall()
+                    remanente = abono_prestamos
+                    # El reparto entre préstamos se calcula en memoria y se escribe en lote
+                    saldos = []; abonos = []
+                    for pid_p, monto_orig in prestamos:
+                        if remanente <= 0: break
+                        if remanente >= monto_orig:
+                            saldos.append(('Pagado', 0, pid_p))
+                            abono_real = monto_orig
+                            remanente -= monto_orig
+                        else:
+                            saldos.append(('Pendiente', monto_orig - remanente, pid_p))
+                            abono_real = remanente
+                            remanente = 0
+                        abonos.append((pid_p, abono_real, hoy_iso, "Deducción Nómina"))
+                    cursor.executemany("UPDATE prestamos SET estado=?, monto=? WHERE id=?", saldos)
+                    cursor.executemany("INSERT INTO abonos_prestamos (prestamo_id, valor, fecha, descripcion) VALUES (?,?,?,?)", abonos)
             
-            for met, val in lista_pagos_nomina:
-                if val > 0: 
-                    cursor.execute("INSERT INTO gastos (fecha, tipo, categoria, descripcion, metodo, valor) VALUES (?,?,?,?,?,?)", 
-                                  (hoy_iso, "GASTO", "Nomina", f"Nomina {profesional_nombre}", met, val))
+                cursor.executemany(_SQL_INSERT_GASTO, 
+                                   [(hoy_iso, "GASTO", "Nomina", f"Nomina {profesional_nombre}", met, val) for met, val in lista_pagos_nomina if val > 0])
             
-            conn.commit()
             return True, "Nómina Liquidada"
         except Exception as e:
-            conn.rollback()
             return False, str(e)
-        finally:
-            conn.close()
 
     # ==========================================
     #  CONSULTAS SEGURAS (ADAPTADAS A TERCEROS)
     # ==========================================
     def traer_agenda_filtrada(self, fecha_ui=None, busqueda=None):
         # JOINS actualizados a tabla terceros
-        sql = '''SELECT c.id, c.fecha, c.hora_inicio, 
+        # La fecha sale formateada desde SQL (ver _sql_f_ui)
+        sql = f'''SELECT c.id, {_sql_f_ui('c.fecha')}, c.hora_inicio, 
                         t_cli.nombre_completo, t_cli.telefono, 
                         s.nombre, 
                         t_pro.nombre_completo, c.estado 
@@ -790,12 +1201,11 @@ class SistemaSalonDB:
         sql += " AND c.estado != 'Cancelado' ORDER BY c.fecha ASC, c.hora_inicio ASC"
         
         with self.conectar() as conn: 
-            rows = conn.execute(sql, params).fetchall()
-            return [(r[0], self.f_to_ui(r[1]), r[2], r[3], r[4], r[5], r[6], r[7]) for r in rows]
+            return conn.execute(sql, params).fetchall()
 
     def traer_citas_futuras_cliente(self, texto_busqueda):
         busqueda = f"%{texto_busqueda}%"
-        sql = '''SELECT c.id, c.fecha, c.hora_inicio, t_cli.nombre_completo, t_cli.telefono, s.nombre, t_pro.nombre_completo, c.estado 
+        sql = f'''SELECT c.id, {_sql_f_ui('c.fecha')}, c.hora_inicio, t_cli.nombre_completo, t_cli.telefono, s.nombre, t_pro.nombre_completo, c.estado 
                  FROM citas c 
                  JOIN terceros t_cli ON c.cliente_id = t_cli.id 
                  JOIN servicios s ON c.servicio_id = s.id 
@@ -803,77 +1213,111 @@ class SistemaSalonDB:
                  WHERE (t_cli.nombre_completo LIKE ? OR t_cli.telefono LIKE ?) AND c.estado IN ('Pendiente', 'Reagendado')
                  ORDER BY c.fecha ASC, c.hora_inicio ASC'''
         with self.conectar() as conn: 
-            rows = conn.execute(sql, (busqueda, busqueda)).fetchall()
-            return [(r[0], self.f_to_ui(r[1]), r[2], r[3], r[4], r[5], r[6], r[7]) for r in rows]
+            return conn.execute(sql, (busqueda, busqueda)).fetchall()
 
     def buscar_deudas_pendientes(self, tipo, texto):
         busqueda = f"%{texto}%"
         with self.conectar() as conn:
             if tipo == 'CLIENTE':
-                sql = '''SELECT p.id, p.fecha, t.nombre_completo, t.telefono, p.monto, 'Venta Crédito'
+                sql = f'''SELECT p.id, {_sql_f_ui('p.fecha')}, t.nombre_completo, t.telefono, p.monto, 'Venta Crédito'
                          FROM pagos p JOIN citas c ON p.cita_id = c.id JOIN terceros t ON c.cliente_id = t.id 
-                         WHERE p.metodo = 'CREDITO' AND (t.nombre_completo LIKE ? OR t.telefono LIKE ?) ORDER BY p.fecha DESC'''
-                rows = conn.execute(sql, (busqueda, busqueda)).fetchall()
-                return [(r[0], self.f_to_ui(r[1]), r[2], r[3], r[4], r[5]) for r in rows]
+                         WHERE p.metodo = 'CREDITO' AND (t.nombre_completo LIKE ? OR t.telefono LIKE ?) ORDER BY p.fecha DESC, p.id'''
+                return conn.execute(sql, (busqueda, busqueda)).fetchall()
             elif tipo == 'PROFESIONAL':
-                sql = '''SELECT pr.id, pr.fecha, t.nombre_completo, 'N/A', pr.monto, pr.descripcion
+                sql = f'''SELECT pr.id, {_sql_f_ui('pr.fecha')}, t.nombre_completo, 'N/A', pr.monto, pr.descripcion
                          FROM prestamos pr JOIN terceros t ON pr.profesional_id = t.id
-                         WHERE pr.estado = 'Pendiente' AND t.nombre_completo LIKE ? ORDER BY pr.fecha DESC'''
-                rows = conn.execute(sql, (busqueda,)).fetchall()
-                return [(r[0], self.f_to_ui(r[1]), r[2], r[3], r[4], r[5]) for r in rows]
+                         WHERE pr.estado = 'Pendiente' AND t.nombre_completo LIKE ? ORDER BY pr.fecha DESC, pr.id'''
+                return conn.execute(sql, (busqueda,)).fetchall()
         return []
 
     # ... (Se mantienen igual: validar_choque, guardar_paquete_citas pero usando tabla terceros internamente) ...
     def validar_choque(self, fecha_ui, hora_ini, duracion, pro_nombre):
         try:
             fecha_iso = self.f_to_iso(fecha_ui)
-            fmt="%H:%M"
-            ini = datetime.strptime(hora_ini, fmt)
-            fin = ini + timedelta(minutes=int(duracion))
-            h_fin = fin.strftime(fmt)
+            ini = _hm_a_min(hora_ini)
+            fin = ini + int(duracion)
+            h_fin = _min_a_hm(fin)
             
             with self.conectar() as conn:
                 # Obtener ID desde terceros
-                pid = conn.execute("SELECT id FROM terceros WHERE nombre_completo=? AND es_empleado=1", (pro_nombre,)).fetchone()[0]
-                
-                citas = conn.execute('''SELECT hora_inicio, hora_fin FROM citas 
-                       WHERE fecha=? AND profesional_id=? AND estado!='Cancelado' ''', (fecha_iso, pid)).fetchall()
-                
-                bloqueos = conn.execute('''SELECT hora_inicio, hora_fin, motivo FROM bloqueos 
-                       WHERE fecha=? AND (profesional_id=? OR profesional_id=0)''', (fecha_iso, pid)).fetchall()
-            
-            for ci, cf in citas:
-                if (ini < datetime.strptime(cf, fmt)) and (fin > datetime.strptime(ci, fmt)): 
-                    return True, f"Ocupado ({ci}-{cf})"
-            
-            for bi, bf, mot in bloqueos:
-                if (ini < datetime.strptime(bf, fmt)) and (fin > datetime.strptime(bi, fmt)): 
-                    return True, f"BLOQUEADO: {mot}"
+                pid = self._buscar_empleado(conn, pro_nombre)[0]
+                # El cruce lo resuelve SQL con el índice: solo vuelve la primera fila que choca.
+                # Un rango que pasa de medianoche se compara hasta '24:00' (h_fin da la vuelta)
+                choque = self._buscar_choque(conn, fecha_iso, pid, _min_a_hm(ini), h_fin if fin < 1440 else "24:00")
             
+            if choque: return True, choque
             return False, h_fin
         except Exception as e: return True, str(e)
 
+    def _buscar_choque(self, conn, fecha_iso, pid, h_ini, h_fin):
+        """Busca en SQL una cita o bloqueo que se cruce con el rango [h_ini, h_fin) del profesional.
+        Las horas 'HH:MM' se comparan como texto: por eso se guardan siempre con ceros (_hora_hm).
+        Retorna el mensaje del choque o None."""
+        cita = conn.execute('''SELECT hora_inicio, hora_fin FROM citas 
+                               WHERE fecha=? AND profesional_id=? AND estado!='Cancelado' AND hora_inicio < ? AND hora_fin > ? LIMIT 1''',
+                            (fecha_iso, pid, h_fin, h_ini)).fetchone()
+        if cita: return f"Ocupado ({cita[0]}-{cita[1]})"
+        bloqueo = conn.execute('''SELECT motivo FROM bloqueos 
+                                  WHERE fecha=? AND profesional_id IN (?, 0) AND hora_inicio < ? AND hora_fin > ? LIMIT 1''',
+                               (fecha_iso, pid, h_fin, h_ini)).fetchone()
+        if bloqueo: return f"BLOQUEADO: {bloqueo[0]}"
+        return None
+
+    def agendar_cita(self, cliente, telefono, profesional, servicio, fecha_ui, hora_ini):
+        """Agenda una cita completa en UNA transacción: datos del servicio, validación de choque,
+        cliente (se crea si no existe) e inserción. Retorna (ok, mensaje)."""
+        fecha_iso = self.f_to_iso(fecha_ui)
+        try:
+            srv = self.get_info_servicio(servicio)
+            if not srv: return False, "El servicio no existe"
+            sid, duracion, precio = srv
+            with self.transaccion() as conn:
+                pro = self._buscar_empleado(conn, profesional)
+                if not pro: return False, "El profesional no existe"
+                pid = pro[0]
+
+                try:
+                    ini = _hm_a_min(hora_ini)
+                except (KeyError, ValueError, AttributeError):
+                    return False, f"Hora inválida: {hora_ini}"
+                fin = ini + int(duracion)
+                h_ini, h_fin = _min_a_hm(ini), _min_a_hm(fin)
+                # Si la cita pasa de medianoche, para comparar se usa el fin del día
+                choque = self._buscar_choque(conn, fecha_iso, pid, h_ini, h_fin if fin < 1440 else "24:00")
+                if choque: return False, f"Ocupado: {choque}"
+
+                cli = self._buscar_cliente(conn, telefono)
+                if cli:
+                    cli_id = cli[0]
+                else:
+                    cli_id = conn.execute("INSERT INTO terceros (nombre_completo, nombre1, telefono, es_cliente, fecha_registro) VALUES (?,?,?,1,?)", 
+                                          (cliente, cliente, str(telefono), datetime.now().strftime("%Y-%m-%d"))).lastrowid
+                conn.execute(_SQL_INSERT_CITA, (cli_id, pid, sid, fecha_iso, h_ini, h_fin, precio))
+            return True, "Agendado"
+        except Exception as e: return False, str(e)
+
     def guardar_paquete_citas(self, carrito, nom, tel):
         try:
-            # Lógica mejorada: Buscar cliente, si no existe, CREAR UNO BÁSICO en Terceros
-            cli = self.buscar_cliente(tel)
-            if not cli:
-                with self.conectar() as conn: 
+            with self.transaccion() as conn:
+                # Lógica mejorada: Buscar cliente, si no existe, CREAR UNO BÁSICO en Terceros
+                cli = self._buscar_cliente(conn, tel)
+                if not cli:
                     # Insertar en Terceros con flag cliente
                     cur = conn.execute("INSERT INTO terceros (nombre_completo, nombre1, telefono, es_cliente, fecha_registro) VALUES (?,?,?,1,?)", 
                                      (nom, nom, str(tel), datetime.now().strftime("%Y-%m-%d")))
                     cli_id = cur.lastrowid
-            else: 
-                cli_id = cli[0]
-            
-            with self.conectar() as conn:
-                for i in carrito:
-                    pid = conn.execute("SELECT id FROM terceros WHERE nombre_completo=? AND es_empleado=1",(i['profesional'],)).fetchone()[0]
-                    sid = conn.execute("SELECT id FROM servicios WHERE nombre=?",(i['servicio'],)).fetchone()[0]
-                    f_iso = self.f_to_iso(i['fecha'])
-                    
-                    conn.execute("INSERT INTO citas (cliente_id, profesional_id, servicio_id, fecha, hora_inicio, hora_fin, precio_final, estado) VALUES (?,?,?,?,?,?,?, 'Pendiente')",
-                                 (cli_id, pid, sid, f_iso, i['inicio'], i['fin'], i['precio']))
+                else: 
+                    cli_id = cli[0]
+
+                # Ids de profesionales y servicios del carrito: una consulta IN para cada tabla
+                # (ORDER BY id DESC: si un nombre se repite, gana el registro más antiguo)
+                pros = list({i['profesional'] for i in carrito}); srvs = list({i['servicio'] for i in carrito})
+                pro_ids = dict(conn.execute(f"SELECT nombre_completo, id FROM terceros WHERE es_empleado=1 AND nombre_completo IN ({','.join('?' * len(pros))}) ORDER BY id DESC", pros).fetchall())
+                srv_ids = dict(conn.execute(f"SELECT nombre, id FROM servicios WHERE nombre IN ({','.join('?' * len(srvs))}) ORDER BY id DESC", srvs).fetchall())
+                filas = [(cli_id, pro_ids[i['profesional']], srv_ids[i['servicio']], self.f_to_iso(i['fecha']), _hora_hm(i['inicio']), _hora_hm(i['fin']), i['precio'])
+                         for i in carrito]
+                # Todo el carrito con una sola sentencia preparada, dentro de la misma transacción
+                conn.executemany(_SQL_INSERT_CITA, filas)
             return True, "Agendado"
         except Exception as e: return False, str(e)
 
@@ -889,16 +1333,17 @@ class SistemaSalonDB:
                                    WHERE c.fecha = ? AND c.estado != 'Cancelado' ''', (fecha_iso,)).fetchall()
             for c in citas: data.append(c + ('CITA',))
             
-            pros = [x[0] for x in conn.execute("SELECT nombre_completo FROM terceros WHERE es_empleado=1").fetchall()]
-            bloqs = conn.execute('''SELECT profesional_id, hora_inicio, hora_fin, motivo FROM bloqueos WHERE fecha=?''', (fecha_iso,)).fetchall()
+            pros = [x[0] for x in conn.execute("SELECT nombre_completo FROM terceros WHERE es_empleado=1 ORDER BY id").fetchall()]
+            # El nombre del profesional llega con el JOIN (antes era una consulta por bloqueo)
+            bloqs = conn.execute('''SELECT b.profesional_id, b.hora_inicio, b.hora_fin, b.motivo, t.nombre_completo
+                                   FROM bloqueos b LEFT JOIN terceros t ON t.id = b.profesional_id
+                                   WHERE b.fecha=? ORDER BY b.id''', (fecha_iso,)).fetchall()
             
-            for pid, hi, hf, mot in bloqs:
-                fmt = "%H:%M"
-                dur = int((datetime.strptime(hf, fmt) - datetime.strptime(hi, fmt)).total_seconds() / 60)
+            for pid, hi, hf, mot, p_nom in bloqs:
+                dur = _hm_a_min(hf) - _hm_a_min(hi)
                 if pid == 0: 
                     for p_nombre in pros: data.append((p_nombre, hi, dur, "BLOQUEADO", mot, 'BLOQUEO'))
                 else:
-                    p_nom = conn.execute("SELECT nombre_completo FROM terceros WHERE id=?", (pid,)).fetchone()[0]
                     data.append((p_nom, hi, dur, "NO DISP.", mot, 'BLOQUEO'))
         return data
 
@@ -911,17 +1356,20 @@ class SistemaSalonDB:
         pagos_total = 0; gastos_total = 0; descuentos_total = 0; flujo = {}
         
         with self.conectar() as conn:
-            pagos = conn.execute("SELECT metodo, monto FROM pagos WHERE fecha BETWEEN ? AND ?", (d1_iso, d2_iso)).fetchall()
+            # Totales agrupados en SQL; ORDER BY MIN(id) conserva el orden en que aparece cada medio
+            pagos = conn.execute('''SELECT metodo, SUM(monto) FROM pagos WHERE fecha BETWEEN ? AND ?
+                                    GROUP BY metodo ORDER BY MIN(id)''', (d1_iso, d2_iso))
             for met, mon in pagos:
                 if met != "CREDITO": 
                     if met not in flujo: flujo[met] = {'in': 0, 'out': 0}
                     flujo[met]['in'] += mon
                 pagos_total += mon
             
-            gastos = conn.execute("SELECT categoria, metodo, valor FROM gastos WHERE fecha BETWEEN ? AND ?", (d1_iso, d2_iso)).fetchall()
-            for cat, met, val in gastos:
+            gastos = conn.execute('''SELECT categoria = 'Descuento Ventas', metodo, SUM(valor) FROM gastos WHERE fecha BETWEEN ? AND ?
+                                     GROUP BY 1, 2 ORDER BY MIN(id)''', (d1_iso, d2_iso))
+            for es_descuento, met, val in gastos:
                 gastos_total += val
-                if cat == "Descuento Ventas": descuentos_total += val
+                if es_descuento: descuentos_total += val
                 else:
                     if met not in flujo: flujo[met] = {'in': 0, 'out': 0}
                     flujo[met]['out'] += val
@@ -933,76 +1381,67 @@ class SistemaSalonDB:
     def generar_excel_visual_completo(self, ruta):
         if not HAS_OPENPYXL: return False, "Falta librería openpyxl"
         try:
-            wb = Workbook()
-            if 'Sheet' in wb.sheetnames: del wb['Sheet']
-            
-            fill_header = PatternFill("solid", fgColor="D3D3D3")
-            fill_cita = PatternFill("solid", fgColor="90EE90")
-            center_align = Alignment(horizontal='center', vertical='center', wrap_text=True)
-            thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-            bold_font = Font(bold=True)
+            # Modo write_only: cada fila se escribe al archivo al agregarla, en memoria solo queda la hoja en curso
+            wb = Workbook(write_only=True)
             
             with self.conectar() as conn:
                 pros = [x[0] for x in conn.execute("SELECT nombre_completo FROM terceros WHERE es_empleado=1 ORDER BY id").fetchall()]
-                fechas_citas_iso = [x[0] for x in conn.execute("SELECT DISTINCT fecha FROM citas WHERE estado!='Cancelado'").fetchall()]
-                fechas_unicas_iso = sorted(list(set(fechas_citas_iso)))
+                # Todas las citas en una sola consulta, ordenadas por fecha: cada hoja toma su grupo.
+                # LEFT JOIN: un día sale aunque sus citas apunten a un servicio, profesional o cliente
+                # ya borrado (esas citas quedan fuera de la grilla, como antes)
+                todas = conn.execute('''SELECT c.fecha, t_pro.nombre_completo, c.hora_inicio, s.duracion_min, t_cli.nombre_completo, s.nombre, c.precio_final,
+                                                t_pro.id IS NOT NULL AND s.id IS NOT NULL AND t_cli.id IS NOT NULL
+                                         FROM citas c 
+                                         LEFT JOIN terceros t_pro ON c.profesional_id = t_pro.id 
+                                         LEFT JOIN servicios s ON c.servicio_id = s.id 
+                                         LEFT JOIN terceros t_cli ON c.cliente_id = t_cli.id
+                                         WHERE c.estado != 'Cancelado' ORDER BY c.fecha, c.hora_inicio, c.id''').fetchall()
                 
-                if not fechas_unicas_iso:
+                if not todas:
                     ws = wb.create_sheet("Sin Citas")
-                    ws['A1'] = "No hay citas registradas"
+                    ws.append(["No hay citas registradas"])
                     wb.save(ruta)
                     return True, f"Excel vacío guardado en {ruta}"
                 
-                for fecha_iso in fechas_unicas_iso:
+                # Franjas de 20 minutos de 06:00 a 22:00: iguales para todas las hojas
+                horas = [_min_a_hm(m) for m in range(6 * 60, 22 * 60 + 1, 20)]
+                time_map = {h: i for i, h in enumerate(horas)}
+                col_map = {p: i for i, p in enumerate(pros)}
+                
+                for fecha_iso, citas in groupby(todas, key=lambda r: r[0]):
                     fecha_ui = self.f_to_ui(fecha_iso)
                     ws = wb.create_sheet(fecha_ui)
-                    
-                    ws.cell(row=1, column=1, value="HORA").font = bold_font
-                    ws.cell(row=1, column=1).fill = fill_header
                     ws.column_dimensions['A'].width = 10
+                    for i in range(len(pros)): ws.column_dimensions[chr(66 + i)].width = 25
                     
-                    col_map = {}
-                    for i, p in enumerate(pros):
-                        col_idx = i + 2
-                        c = ws.cell(row=1, column=col_idx, value=p.upper())
-                        c.font = bold_font; c.fill = fill_header; c.alignment = center_align; c.border = thin_border
-                        ws.column_dimensions[chr(64 + col_idx)].width = 25
-                        col_map[p] = col_idx
-                    
-                    time_map = {}
-                    row_idx = 2
-                    t_start = datetime.strptime("06:00", "%H:%M")
-                    t_end = datetime.strptime("22:00", "%H:%M")
-                    curr_t = t_start
-                    while curr_t <= t_end:
-                        hora_str = curr_t.strftime("%H:%M")
-                        cell = ws.cell(row=row_idx, column=1, value=hora_str)
-                        cell.border = thin_border
-                        time_map[hora_str] = row_idx
-                        curr_t += timedelta(minutes=20)
-                        row_idx += 1
+                    # Las filas se escriben en orden, así que primero se arma la grilla de la hoja:
+                    # (fila, columna) -> [texto, centrado] de cada franja ocupada por una cita
+                    grilla = {}
+                    for _, pro_nom, h_ini, dur, cli_nom, srv_nom, precio, completa in citas:
+                        if completa and pro_nom in col_map and h_ini in time_map:
+                            r_start = time_map[h_ini]; c_idx = col_map[pro_nom]
+                            for b in range(min(max(int(dur / 20), 1), len(horas) - r_start)):
+                                celda = grilla.setdefault((r_start + b, c_idx), [None, False])
+                                if b == 0: celda[0] = f"{cli_nom}\n{srv_nom}"; celda[1] = True
                     
-                    citas = conn.execute('''SELECT t_pro.nombre_completo, c.hora_inicio, s.duracion_min, t_cli.nombre_completo, s.nombre, c.precio_final
-                                            FROM citas c 
-                                            JOIN terceros t_pro ON c.profesional_id = t_pro.id 
-                                            JOIN servicios s ON c.servicio_id = s.id 
-                                            JOIN terceros t_cli ON c.cliente_id = t_cli.id
-                                            WHERE c.fecha = ? AND c.estado != 'Cancelado' ''', (fecha_iso,)).fetchall()
+                    cell = WriteOnlyCell(ws, value="HORA"); cell.font = _XL_NEGRITA; cell.fill = _XL_FILL_HEADER
+                    fila = [cell]
+                    for p in pros:
+                        cell = WriteOnlyCell(ws, value=p.upper())
+                        cell.font = _XL_NEGRITA; cell.fill = _XL_FILL_HEADER; cell.alignment = _XL_CENTRO; cell.border = _XL_BORDE
+                        fila.append(cell)
+                    ws.append(fila)
                     
-                    for pro_nom, h_ini, dur, cli_nom, srv_nom, precio in citas:
-                        if pro_nom in col_map:
-                            bloques = int(dur / 20)
-                            if bloques < 1: bloques = 1
-                            if h_ini in time_map:
-                                r_start = time_map[h_ini]
-                                c_idx = col_map[pro_nom]
-                                for b in range(bloques):
-                                    if (r_start + b) < row_idx:
-                                        cell = ws.cell(row=r_start + b, column=c_idx)
-                                        cell.fill = fill_cita; cell.border = thin_border
-                                        if b == 0: 
-                                            cell.value = f"{cli_nom}\n{srv_nom}"
-                                            cell.alignment = center_align
+                    for r, hora_str in enumerate(horas):
+                        cell = WriteOnlyCell(ws, value=hora_str); cell.border = _XL_BORDE
+                        fila = [cell]
+                        for c_idx in range(len(pros)):
+                            celda = grilla.get((r, c_idx))
+                            if celda is None: fila.append(None); continue
+                            cell = WriteOnlyCell(ws, value=celda[0]); cell.fill = _XL_FILL_CITA; cell.border = _XL_BORDE
+                            if celda[1]: cell.alignment = _XL_CENTRO
+                            fila.append(cell)
+                        ws.append(fila)
             
             wb.save(ruta)
             return True, f"Libro generado: {ruta}"
@@ -1058,16 +1497,30 @@ class SistemaSalonDB:
 
     def importar_clientes_masivo(self, ruta_archivo):
         try:
-            df = pd.read_excel(ruta_archivo)
-            if 'Nombre' not in df.columns or 'Telefono' not in df.columns: return False, "Requiere columnas Nombre y Telefono"
-            count = 0
-            with self.conectar() as conn:
-                for _, row in df.iterrows():
-                    try:
-                        conn.execute("INSERT INTO terceros (nombre_completo, nombre1, telefono, es_cliente, fecha_registro) VALUES (?,?,?,1,?)", 
-                                     (str(row['Nombre']), str(row['Nombre']), str(row['Telefono']), datetime.now().strftime("%Y-%m-%d")))
-                        count += 1
-                    except sqlite3.IntegrityError: pass
+            if not HAS_OPENPYXL: return False, "Falta librería openpyxl"
+            # Lectura en modo read_only: las filas llegan como tuplas, sin armar un DataFrame
+            wb = load_workbook(ruta_archivo, read_only=True, data_only=True)
+            try:
+                filas_xl = wb.active.iter_rows(values_only=True)
+                encabezado = list(next(filas_xl, ()))
+                if 'Nombre' not in encabezado or 'Telefono' not in encabezado: return False, "Requiere columnas Nombre y Telefono"
+                i_nom = encabezado.index('Nombre'); i_tel = encabezado.index('Telefono')
+                hoy = datetime.now().strftime("%Y-%m-%d")
+                filas = []
+                for fila in filas_xl:
+                    nom = fila[i_nom] if i_nom < len(fila) else None
+                    tel = fila[i_tel] if i_tel < len(fila) else None
+                    if nom is None and tel is None: continue  # Fila vacía
+                    nom = "" if nom is None else str(nom)
+                    filas.append((nom, nom, "" if tel is None else str(tel), hoy))
+            finally:
+                wb.close()
+            # Todo el archivo en una sola transacción explícita (un solo COMMIT al final);
+            # OR IGNORE salta los repetidos sin cortar la transacción
+            with self.transaccion() as conn:
+                # Una sola sentencia preparada para todas las filas (rowcount suma las insertadas)
+                count = conn.executemany("INSERT OR IGNORE INTO terceros (nombre_completo, nombre1, telefono, es_cliente, fecha_registro) VALUES (?,?,?,1,?)", 
+                                         filas).rowcount
             return True, f"Importados {count}"
         except Exception as e: return False, str(e)
 
@@ -1082,9 +1535,9 @@ class SistemaSalonDB:
         nueva_fecha_iso = self.f_to_iso(nueva_fecha_ui)
         try:
             with self.conectar() as conn:
-                pid = conn.execute("SELECT id FROM terceros WHERE nombre_completo=? AND es_empleado=1", (nuevo_pro,)).fetchone()[0]
+                pid = self._buscar_empleado(conn, nuevo_pro)[0]
                 conn.execute("UPDATE citas SET fecha=?, hora_inicio=?, hora_fin=?, profesional_id=?, estado='Reagendado' WHERE id=?", 
-                             (nueva_fecha_iso, nueva_hora, fin_o_msg, pid, id_cita))
+                             (nueva_fecha_iso, _hora_hm(nueva_hora), fin_o_msg, pid, id_cita))
             return True, "Cita Reagendada"
         except Exception as e: return False, str(e)
 
@@ -1097,20 +1550,21 @@ class SistemaSalonDB:
     def crear_bloqueo(self, pro_nombre, f_inicio, f_fin, h_ini, h_fin, motivo):
         try:
             d_ini = datetime.strptime(f_inicio, "%d-%m-%y"); d_fin = datetime.strptime(f_fin, "%d-%m-%y")
-            with self.conectar() as conn:
+            h_ini, h_fin = _hora_hm(h_ini), _hora_hm(h_fin)
+            with self.transaccion() as conn:
                 if pro_nombre == "TODOS": pid = 0
-                else: pid = conn.execute("SELECT id FROM terceros WHERE nombre_completo=? AND es_empleado=1", (pro_nombre,)).fetchone()[0]
+                else: pid = self._buscar_empleado(conn, pro_nombre)[0]
                 delta = d_fin - d_ini
-                for i in range(delta.days + 1):
-                    dia_actual = d_ini + timedelta(days=i); fecha_iso = dia_actual.strftime("%Y-%m-%d")
-                    conn.execute("INSERT INTO bloqueos (profesional_id, fecha, hora_inicio, hora_fin, motivo) VALUES (?,?,?,?,?)",
-                                 (pid, fecha_iso, h_ini, h_fin, motivo))
+                # Todos los días del rango en un solo executemany y un solo COMMIT
+                filas = [(pid, (d_ini + timedelta(days=i)).strftime("%Y-%m-%d"), h_ini, h_fin, motivo) for i in range(delta.days + 1)]
+                conn.executemany("INSERT INTO bloqueos (profesional_id, fecha, hora_inicio, hora_fin, motivo) VALUES (?,?,?,?,?)", filas)
             return True, "Bloqueo Creado"
         except Exception as e: return False, str(e)
 
     def establecer_horario_global(self, fecha_ui, h_apertura, h_cierre):
         fecha_iso = self.f_to_iso(fecha_ui)
         try:
+            h_apertura, h_cierre = _hora_hm(h_apertura), _hora_hm(h_cierre)
             with self.conectar() as conn:
                 conn.execute("DELETE FROM bloqueos WHERE fecha=? AND profesional_id=0 AND motivo='Fuera de Horario'", (fecha_iso,))
                 if h_apertura != "00:00": conn.execute("INSERT INTO bloqueos (profesional_id, fecha, hora_inicio, hora_fin, motivo) VALUES (0, ?, '00:00', ?, 'Fuera de Horario')", (fecha_iso, h_apertura))
@@ -1128,33 +1582,38 @@ class SistemaSalonDB:
         hoy_iso = datetime.now().strftime("%Y-%m-%d")
         try:
             with self.conectar() as conn:
-                pid = conn.execute("SELECT id FROM terceros WHERE nombre_completo=? AND es_empleado=1", (profesional,)).fetchone()[0]
+                pid = self._buscar_empleado(conn, profesional)[0]
                 conn.execute("INSERT INTO prestamos (profesional_id, monto, fecha, descripcion) VALUES (?,?,?,?)", (pid, float(monto), hoy_iso, desc))
-                conn.execute("INSERT INTO gastos (fecha, tipo, categoria, descripcion, metodo, valor) VALUES (?,?,?,?,?,?)",
+                conn.execute(_SQL_INSERT_GASTO,
                              (hoy_iso, "GASTO", "Prestamos", f"Prestamo a {profesional}", "Efectivo", float(monto)))
             return True, "Préstamo registrado"
         except Exception as e: return False, str(e)
     
     # Metodos de consulta simples
     def get_info_servicio(self, n):
+        # Sin memoria en el proceso: otro worker o la app de escritorio pueden cambiar el precio
+        # o borrar el servicio. Es una sola búsqueda por índice
         with self.conectar() as conn: return conn.execute("SELECT id, duracion_min, precio FROM servicios WHERE nombre=?",(n,)).fetchone()
     def traer_dias_ocupados(self):
         with self.conectar() as conn: 
-            fechas_iso = [x[0] for x in conn.execute("SELECT DISTINCT fecha FROM citas WHERE estado!='Cancelado'").fetchall()]
-            return [self.f_to_ui(f) for f in fechas_iso]
+            return [x[0] for x in conn.execute(f"SELECT {_sql_f_ui('fecha')} FROM (SELECT DISTINCT fecha FROM citas WHERE estado!='Cancelado')").fetchall()]
     def traer_intervalos_ocupados(self, fecha_ui, pro_nombre):
         fecha_iso = self.f_to_iso(fecha_ui); intervalos = []
         with self.conectar() as conn:
-            pid = conn.execute("SELECT id FROM terceros WHERE nombre_completo=? AND es_empleado=1", (pro_nombre,)).fetchone()[0]
+            pid = self._buscar_empleado(conn, pro_nombre)[0]
             citas = conn.execute('''SELECT hora_inicio, hora_fin FROM citas WHERE fecha = ? AND profesional_id = ? AND estado != 'Cancelado' ''', (fecha_iso, pid)).fetchall()
             intervalos.extend(citas)
-            bloqs = conn.execute('''SELECT hora_inicio, hora_fin FROM bloqueos WHERE fecha=? AND (profesional_id=? OR profesional_id=0)''', (fecha_iso, pid)).fetchall()
+            bloqs = conn.execute('''SELECT hora_inicio, hora_fin FROM bloqueos WHERE fecha=? AND (profesional_id=? OR profesional_id=0) ORDER BY id''', (fecha_iso, pid)).fetchall()
             intervalos.extend(bloqs)
         return intervalos
-    def confirm_asistencia(self, id_c):
-        with self.conectar() as conn: conn.execute("UPDATE citas SET estado='Por Cobrar' WHERE id=?",(id_c,))
     def confirmar_asistencia(self, id_c):
         with self.conectar() as conn: conn.execute("UPDATE citas SET estado='Por Cobrar' WHERE id=?",(id_c,))
+    confirm_asistencia = confirmar_asistencia  # Nombre anterior, mantenido por compatibilidad
+    def confirmar_asistencias(self, ids):
+        # Varias citas en un solo UPDATE (una transacción)
+        ids = list(ids)
+        if not ids: return
+        with self.conectar() as conn: conn.execute(f"UPDATE citas SET estado='Por Cobrar' WHERE id IN ({','.join('?' * len(ids))})", ids)
     def traer_por_cobrar(self):
         sql = '''SELECT t.id, t.nombre_completo, t.telefono, GROUP_CONCAT(c.id), SUM(c.precio_final), GROUP_CONCAT(s.nombre)
                  FROM citas c JOIN terceros t ON c.cliente_id=t.id JOIN servicios s ON c.servicio_id=s.id
@@ -1162,106 +1621,119 @@ class SistemaSalonDB:
         with self.conectar() as conn: return conn.execute(sql).fetchall()
     def traer_lista_bloqueos(self):
         with self.conectar() as conn:
-            rows = conn.execute('''SELECT b.id, CASE WHEN b.profesional_id = 0 THEN 'TODOS' ELSE t.nombre_completo END, b.fecha, b.hora_inicio, b.hora_fin, b.motivo
-                                   FROM bloqueos b LEFT JOIN terceros t ON b.profesional_id = t.id 
-                                   ORDER BY b.fecha DESC LIMIT 50''').fetchall()
-            return [(r[0], r[1], self.f_to_ui(r[2]), r[3], r[4], r[5]) for r in rows]
+            return conn.execute(f'''SELECT b.id, CASE WHEN b.profesional_id = 0 THEN 'TODOS' ELSE t.nombre_completo END, {_sql_f_ui('b.fecha')}, b.hora_inicio, b.hora_fin, b.motivo
+                                    FROM bloqueos b LEFT JOIN terceros t ON b.profesional_id = t.id 
+                                    ORDER BY b.fecha DESC, b.id LIMIT 50''').fetchall()
     def traer_profesionales_habilitados_por_fecha(self, fecha_ui):
         fecha_iso = self.f_to_iso(fecha_ui)
         with self.conectar() as conn:
-            todos = conn.execute("SELECT id, nombre_completo FROM terceros WHERE es_empleado=1").fetchall()
-            bloqueos = conn.execute("SELECT profesional_id, hora_inicio, hora_fin FROM bloqueos WHERE fecha=?", (fecha_iso,)).fetchall()
-            for bid, ini, fin in bloqueos:
-                if bid == 0 and ((ini=="00:00" and fin=="23:59") or (ini=="00:00" and fin=="00:00")): return []
-            disponibles = []
-            for pid, nom in todos:
-                bloqueado = False
-                for bid, ini, fin in bloqueos:
-                    if bid == pid and ((ini=="00:00" and fin=="23:59") or (ini=="00:00" and fin=="00:00")):
-                        bloqueado = True; break
-                if not bloqueado: disponibles.append(nom)
-            return disponibles
+            # Un profesional no está habilitado si tiene (él o TODOS, id 0) un bloqueo de día completo
+            return [x[0] for x in conn.execute('''SELECT t.nombre_completo FROM terceros t
+                                                 WHERE t.es_empleado=1 AND NOT EXISTS (
+                                                     SELECT 1 FROM bloqueos b WHERE b.fecha=? AND b.profesional_id IN (t.id, 0)
+                                                     AND b.hora_inicio='00:00' AND b.hora_fin IN ('23:59', '00:00'))
+                                                 ORDER BY t.id''', (fecha_iso,)).fetchall()]
     def traer_info_liquidacion(self, profesional, f1_str, f2_str):
-        d1_iso = self.f_to_iso(f1_str); d2_iso = self.f_to_iso(f2_str); ventas=[]; prestamos=[]
+        d1_iso = self.f_to_iso(f1_str); d2_iso = self.f_to_iso(f2_str)
         with self.conectar() as conn:
-            raw_v = conn.execute('''SELECT c.id, c.fecha, t_cli.nombre_completo, s.nombre, c.precio_final, t_pro.comision 
+            cur = conn.cursor()
+            cur.row_factory = sqlite3.Row # Se lee por nombre de columna; se entregan tuplas como antes
+            # Fecha formateada y comisión calculada en la consulta
+            ventas = [(r['id'], r['fecha'], r['cliente'], r['servicio'], r['precio_final'], r['comision']) for r in cur.execute(f'''SELECT c.id, {_sql_f_ui('c.fecha')} AS fecha, t_cli.nombre_completo AS cliente, s.nombre AS servicio, c.precio_final, c.precio_final * (t_pro.comision / 100.0) AS comision
                                     FROM citas c 
                                     JOIN terceros t_pro ON c.profesional_id = t_pro.id 
                                     JOIN terceros t_cli ON c.cliente_id = t_cli.id 
                                     JOIN servicios s ON c.servicio_id = s.id
-                                    WHERE t_pro.nombre_completo = ? AND c.estado = 'Pagado' AND c.nomina_pagada = 0 AND c.fecha BETWEEN ? AND ?''', 
-                                    (profesional, d1_iso, d2_iso)).fetchall()
-            for r in raw_v: ventas.append((r[0], self.f_to_ui(r[1]), r[2], r[3], r[4], r[4]*(r[5]/100))) 
-            raw_p = conn.execute('''SELECT pr.id, pr.fecha, pr.monto, pr.descripcion FROM prestamos pr JOIN terceros t ON pr.profesional_id = t.id
-                                        WHERE t.nombre_completo = ? AND pr.estado = 'Pendiente' ''', (profesional,)).fetchall()
-            for r in raw_p: prestamos.append((r[0], self.f_to_ui(r[1]), r[2], r[3]))
+                                    WHERE t_pro.nombre_completo = ? AND c.estado = 'Pagado' AND c.nomina_pagada = 0 AND c.fecha BETWEEN ? AND ?
+                                    ORDER BY c.fecha, c.hora_inicio, c.id''', 
+                                    (profesional, d1_iso, d2_iso))]
+            prestamos = [(r['id'], r['fecha'], r['monto'], r['descripcion']) for r in cur.execute(f'''SELECT pr.id, {_sql_f_ui('pr.fecha')} AS fecha, pr.monto, pr.descripcion FROM prestamos pr JOIN terceros t ON pr.profesional_id = t.id
+                                        WHERE t.nombre_completo = ? AND pr.estado = 'Pendiente' ORDER BY pr.id''', (profesional,))]
         return ventas, prestamos
     def traer_estado_cuenta_prestamos(self, profesional):
         with self.conectar() as conn:
-            pid = conn.execute("SELECT id FROM terceros WHERE nombre_completo=? AND es_empleado=1", (profesional,)).fetchone()[0]
-            rows = conn.execute("SELECT fecha, descripcion, monto, estado FROM prestamos WHERE profesional_id = ? ORDER BY id DESC", (pid,)).fetchall()
-            return [(self.f_to_ui(r[0]), r[1], r[2], r[3]) for r in rows]
+            pid = self._buscar_empleado(conn, profesional)[0]
+            return conn.execute(f"SELECT {_sql_f_ui('fecha')}, descripcion, monto, estado FROM prestamos WHERE profesional_id = ? ORDER BY id DESC", (pid,)).fetchall()
     def traer_kardex_prestamos(self, profesional):
         try:
             with self.conectar() as conn:
-                pid = conn.execute("SELECT id FROM terceros WHERE nombre_completo=? AND es_empleado=1", (profesional,)).fetchone()
+                pid = self._buscar_empleado(conn, profesional)
                 if not pid: return []
                 pid = pid[0]
-                prestamos = conn.execute("SELECT fecha, descripcion, monto, 'PRESTAMO (+)', id FROM prestamos WHERE profesional_id = ?", (pid,)).fetchall()
-                abonos = conn.execute("SELECT a.fecha, a.descripcion, a.valor, 'ABONO (-)', p.id FROM abonos_prestamos a JOIN prestamos p ON a.prestamo_id = p.id WHERE p.profesional_id = ?", (pid,)).fetchall()
-                movs = []
-                for p in prestamos: movs.append({'f': p[0], 'd': p[1], 'm': p[2], 't': 'PRESTAMO (+)', 'dt': datetime.strptime(p[0], "%Y-%m-%d")})
-                for a in abonos: movs.append({'f': a[0], 'd': a[1], 'm': a[2], 't': 'ABONO (-)', 'dt': datetime.strptime(a[0], "%Y-%m-%d")})
-                movs.sort(key=lambda x: x['dt']); kardex = []; saldo = 0
-                for m in movs:
-                    saldo += m['m'] if m['t'] == 'PRESTAMO (+)' else -m['m']
-                    kardex.append((self.f_to_ui(m['f']), m['t'], m['d'], f"${m['m']:,.0f}", f"${saldo:,.0f}"))
+                # Préstamos y abonos en una sola consulta, ya ordenados por fecha en SQLite
+                # (el mismo día: primero los préstamos, luego los abonos, cada uno en orden de registro)
+                cur = conn.cursor()
+                cur.row_factory = sqlite3.Row
+                movs = cur.execute('''SELECT fecha, descripcion, monto, 'PRESTAMO (+)' AS tipo, 0 AS k, id FROM prestamos WHERE profesional_id = ?
+                                        UNION ALL
+                                        SELECT a.fecha, a.descripcion, a.valor, 'ABONO (-)', 1, a.id FROM abonos_prestamos a JOIN prestamos p ON a.prestamo_id = p.id
+                                        WHERE p.profesional_id = ?
+                                        ORDER BY 1, 5, 6''', (pid, pid))
+                kardex = []; saldo = 0
+                for r in movs:
+                    m = r['monto']
+                    saldo += m if r['k'] == 0 else -m
+                    kardex.append((self.f_to_ui(r['fecha']), r['tipo'], r['descripcion'], f"${m:,.0f}", f"${saldo:,.0f}"))
                 return kardex
         except: return []
     def traer_historial_ventas_por_fecha(self, f1, f2):
         d1_iso = self.f_to_iso(f1); d2_iso = self.f_to_iso(f2)
         with self.conectar() as conn:
-            rows = conn.execute('''SELECT p.fecha, t.nombre_completo, s.nombre, p.monto, p.metodo 
-                                   FROM pagos p JOIN citas c ON p.cita_id = c.id 
-                                   JOIN terceros t ON c.cliente_id = t.id 
-                                   JOIN servicios s ON c.servicio_id = s.id 
-                                   WHERE p.fecha BETWEEN ? AND ? ORDER BY p.fecha DESC''', (d1_iso, d2_iso)).fetchall()
-            return [(self.f_to_ui(r[0]), r[1], r[2], r[3], r[4]) for r in rows]
+            return conn.execute(f'''SELECT {_sql_f_ui('p.fecha')}, t.nombre_completo, s.nombre, p.monto, p.metodo 
+                                    FROM pagos p JOIN citas c ON p.cita_id = c.id 
+                                    JOIN terceros t ON c.cliente_id = t.id 
+                                    JOIN servicios s ON c.servicio_id = s.id 
+                                    WHERE p.fecha BETWEEN ? AND ? ORDER BY p.fecha DESC, p.id''', (d1_iso, d2_iso)).fetchall()
     def traer_historial_gastos_por_fecha(self, f1, f2):
         d1_iso = self.f_to_iso(f1); d2_iso = self.f_to_iso(f2)
         with self.conectar() as conn:
-            rows = conn.execute("SELECT fecha, tipo, categoria, descripcion, metodo, valor FROM gastos WHERE fecha BETWEEN ? AND ? ORDER BY fecha DESC", (d1_iso, d2_iso)).fetchall()
-            return [(self.f_to_ui(r[0]), r[1], r[2], r[3], r[4], r[5]) for r in rows]
+            return conn.execute(f"SELECT {_sql_f_ui('fecha')}, tipo, categoria, descripcion, metodo, valor FROM gastos WHERE fecha BETWEEN ? AND ? ORDER BY fecha DESC, id", (d1_iso, d2_iso)).fetchall()
     def traer_detalle_ventas(self, f1, f2): return self.traer_historial_ventas_por_fecha(f1, f2)
     def traer_detalle_gastos(self, f1, f2): return self.traer_historial_gastos_por_fecha(f1, f2)
     def registrar_gasto(self, t, c, d, m, v):
-        with self.conectar() as conn: conn.execute("INSERT INTO gastos (fecha, tipo, categoria, descripcion, metodo, valor) VALUES (?,?,?,?,?,?)", (datetime.now().strftime("%Y-%m-%d"), t, c, d, m, v))
+        with self.conectar() as conn: conn.execute(_SQL_INSERT_GASTO, (datetime.now().strftime("%Y-%m-%d"), t, c, d, m, v))
+        return True
+    def registrar_gastos_bulk(self, filas):
+        """Registra varios gastos (tipo, categoria, descripcion, metodo, valor) en una sola transacción"""
+        hoy_iso = datetime.now().strftime("%Y-%m-%d")
+        with self.transaccion() as conn: conn.executemany(_SQL_INSERT_GASTO, [(hoy_iso, t, c, d, m, v) for t, c, d, m, v in filas])
         return True
     def traer_medios_pago(self):
         with self.conectar() as conn: return [x[0] for x in conn.execute("SELECT nombre FROM medios_pago").fetchall()]
     def obtener_cierre_caja_dia(self, fecha_ui):
         fecha_iso = self.f_to_iso(fecha_ui)
         res = {'ventas': {}, 'gastos': {}, 'prestamos': {}, 'detalle_gastos_lista': [], 'detalle_creditos_lista': [], 'abonos_prestamos': {}}
+        # Una sola consulta para todo el cierre. Los totales por medio de pago llegan ya sumados;
+        # solo los créditos y los gastos comunes vienen fila por fila porque se listan en el detalle.
+        # ORDER BY tipo, id: dentro de cada tipo, los medios salen en el orden de su primer movimiento del día
+        sql = '''SELECT 'V' AS tipo, p.metodo, SUM(p.monto), NULL, MIN(p.id) AS id FROM pagos p JOIN citas c ON p.cita_id = c.id JOIN terceros t ON c.cliente_id = t.id
+                   WHERE p.fecha=? GROUP BY p.metodo
+                 UNION ALL
+                 SELECT 'C', NULL, p.monto, t.nombre_completo, p.id FROM pagos p JOIN citas c ON p.cita_id = c.id JOIN terceros t ON c.cliente_id = t.id
+                   WHERE p.fecha=? AND p.metodo = 'CREDITO'
+                 UNION ALL
+                 SELECT 'A', COALESCE(NULLIF(metodo, ''), 'Efectivo'), SUM(valor), NULL, MIN(id) FROM abonos_prestamos
+                   WHERE fecha=? GROUP BY 2
+                 UNION ALL
+                 SELECT 'P', metodo, SUM(valor), NULL, MIN(id) FROM gastos
+                   WHERE fecha=? AND categoria = 'Prestamos' GROUP BY metodo
+                 UNION ALL
+                 SELECT 'G', metodo, valor, descripcion, id FROM gastos
+                   WHERE fecha=? AND categoria IS NOT 'Prestamos' AND categoria IS NOT 'Descuento Ventas'
+                 ORDER BY tipo, id'''
         with self.conectar() as conn:
-            pagos = conn.execute('''SELECT p.metodo, p.monto, t.nombre_completo FROM pagos p JOIN citas c ON p.cita_id = c.id JOIN terceros t ON c.cliente_id = t.id WHERE p.fecha=?''', (fecha_iso,)).fetchall()
-            for met, mon, cli_nom in pagos:
-                res['ventas'][met] = res['ventas'].get(met, 0) + mon
-                if met == 'CREDITO': res['detalle_creditos_lista'].append((f"Crédito: {cli_nom}", mon))
-            try:
-                abonos = conn.execute("SELECT metodo, valor FROM abonos_prestamos WHERE fecha=?", (fecha_iso,)).fetchall()
-                for met, val in abonos:
-                    m = met if met else "Efectivo"
-                    res['abonos_prestamos'][m] = res['abonos_prestamos'].get(m, 0) + val
-            except: pass
-            gastos = conn.execute("SELECT categoria, metodo, valor, descripcion FROM gastos WHERE fecha=?", (fecha_iso,)).fetchall()
-            for cat, met, val, desc in gastos:
-                if cat == 'Prestamos': res['prestamos'][met] = res['prestamos'].get(met, 0) + val
-                elif cat == 'Descuento Ventas': pass
+            for tipo, met, val, txt, _ in conn.execute(sql, (fecha_iso,) * 5):
+                if tipo == 'V': res['ventas'][met] = val
+                elif tipo == 'C': res['detalle_creditos_lista'].append((f"Crédito: {txt}", val))
+                elif tipo == 'A': res['abonos_prestamos'][met] = val
+                elif tipo == 'P': res['prestamos'][met] = val
                 else:
                     res['gastos'][met] = res['gastos'].get(met, 0) + val
-                    res['detalle_gastos_lista'].append((desc, met, val))
+                    res['detalle_gastos_lista'].append((txt, met, val))
         return res
-    def traer_gastos(self): return self.traer_historial_gastos_por_fecha(datetime.now().strftime("%d-%m-%y"), datetime.now().strftime("%d-%m-%y"))
+    def traer_gastos(self):
+        hoy = datetime.now().strftime("%d-%m-%y")
+        return self.traer_historial_gastos_por_fecha(hoy, hoy)
     def guardar_mensaje_wa(self, mensaje):
         try:
             with self.conectar() as conn: conn.execute("INSERT OR REPLACE INTO configuracion (clave, valor) VALUES ('msg_wa', ?)", (mensaje,))
@@ -1274,18 +1746,29 @@ class SistemaSalonDB:
             return res[0] if res else ""
     def obtener_cita_full(self, id_cita):
         with self.conectar() as conn:
-            row = conn.execute('''SELECT c.fecha, c.hora_inicio, t_cli.nombre_completo, t_cli.telefono, s.nombre, t_pro.nombre_completo, c.precio_final
+            cur = conn.cursor()
+            cur.row_factory = sqlite3.Row
+            r = cur.execute(f'''SELECT {_sql_f_ui('c.fecha')} AS fecha, c.hora_inicio, t_cli.nombre_completo AS cliente, t_cli.telefono, s.nombre AS servicio, t_pro.nombre_completo AS profesional, c.precio_final
                      FROM citas c 
                      JOIN terceros t_cli ON c.cliente_id = t_cli.id 
                      JOIN servicios s ON c.servicio_id = s.id 
                      JOIN terceros t_pro ON c.profesional_id = t_pro.id 
                      WHERE c.id = ?''', (id_cita,)).fetchone()
-            if row: return (self.f_to_ui(row[0]), row[1], row[2], row[3], row[4], row[5], row[6])
-            return None
+        # Se entrega una tupla (no sqlite3.Row): la UI la compara, concatena y pasa a Treeview
+        return (r['fecha'], r['hora_inicio'], r['cliente'], r['telefono'], r['servicio'], r['profesional'], r['precio_final']) if r else None
     def exportar_lista_a_excel(self, datos, columnas, ruta):
         if not HAS_OPENPYXL: return False, "Falta openpyxl"
         try:
-            df = pd.DataFrame(datos, columns=columnas); df.to_excel(ruta, index=False)
+            # Filas directo a openpyxl en modo write_only, sin pasar por un DataFrame.
+            # Encabezado con el mismo estilo que ponía pandas (negrita, borde, centrado arriba)
+            wb = Workbook(write_only=True); ws = wb.create_sheet("Sheet1")
+            encabezado = []
+            for col in columnas:
+                cell = WriteOnlyCell(ws, value=col); cell.font = _XL_NEGRITA; cell.border = _XL_BORDE; cell.alignment = _XL_ENCABEZADO
+                encabezado.append(cell)
+            ws.append(encabezado)
+            for fila in datos: ws.append(fila)
+            wb.save(ruta)
             return True, f"Guardado en {ruta}"
         except Exception as e: return False, str(e)
     def traer_cuentas_por_pagar_comisiones(self):
@@ -1295,15 +1778,14 @@ class SistemaSalonDB:
                 WHERE c.estado = 'Pagado' AND c.nomina_pagada = 0 GROUP BY t.nombre_completo''').fetchall()
 
     def traer_cuentas_por_cobrar_creditos(self):
-        sql = '''SELECT p.id, p.fecha, t.nombre_completo, t.telefono, p.monto 
+        sql = f'''SELECT p.id, {_sql_f_ui('p.fecha')}, t.nombre_completo, t.telefono, p.monto 
                  FROM pagos p 
                  JOIN citas c ON p.cita_id = c.id 
                  JOIN terceros t ON c.cliente_id = t.id 
                  WHERE p.metodo = 'CREDITO' AND p.monto > 0 
-                 ORDER BY p.fecha ASC'''
+                 ORDER BY p.fecha ASC, p.id'''
         with self.conectar() as conn:
-            rows = conn.execute(sql).fetchall()
-            return [(r[0], self.f_to_ui(r[1]), r[2], r[3], r[4]) for r in rows]
+            return conn.execute(sql).fetchall()
 
     # ==========================================
     #  MODIFICADO: TICKET CON DATOS REALES
@@ -1327,11 +1809,15 @@ class SistemaSalonDB:
             y = ALTO_PAPEL - 5 * mm
             center_x = ANCHO_PAPEL / 2
             
-            # 1. LOGO (Si existe logo.png)
-            if os.path.exists("logo.png"):
+            # 1. LOGO (Si existe logo.png). Se lee y decodifica una sola vez; queda en memoria
+            # hasta que guardar_datos_empresa copie un logo nuevo
+            if 'logo' not in self._cfg_cache:
+                try: self._cfg_cache['logo'] = ImageReader("logo.png") if os.path.exists("logo.png") else None
+                except: self._cfg_cache['logo'] = None
+            if self._cfg_cache['logo'] is not None:
                 try:
                     # Dibujar logo centrado
-                    c.drawImage("logo.png", center_x - 12*mm, y - 25*mm, width=24*mm, height=24*mm, preserveAspectRatio=True, mask='auto')
+                    c.drawImage(self._cfg_cache['logo'], center_x - 12*mm, y - 25*mm, width=24*mm, height=24*mm, preserveAspectRatio=True, mask='auto')
                     y -= 30 * mm
                 except: pass
             else:
@@ -1376,19 +1862,16 @@ class SistemaSalonDB:
             y -= 4 * mm
             
             c.setFont("Helvetica", 8)
-            for item in datos_cita['items']:
-                # item viene como (servicio, profesional, hora, precio_str)
-                # Ojo: Adaptar si envias items de productos
-                desc = item[0]
-                precio = item[3]
-                
-                # Cortar texto largo
-                if len(desc) > 22: desc = desc[:22] + "..."
-                
-                c.drawString(2*mm, y, "1")
-                c.drawString(12*mm, y, desc)
-                c.drawRightString(ANCHO_PAPEL - 5*mm, y, precio)
-                y -= 4 * mm
+            # item viene como (servicio, profesional, hora, precio_str)
+            # Ojo: Adaptar si envias items de productos
+            # Textos largos se cortan antes de dibujar; las posiciones x se calculan una vez
+            filas = [(_cortar(item[0]), item[3]) for item in datos_cita['items']]
+            x_cant, x_desc, x_total, paso = 2*mm, 12*mm, ANCHO_PAPEL - 5*mm, 4*mm
+            for desc, precio in filas:
+                c.drawString(x_cant, y, "1")
+                c.drawString(x_desc, y, desc)
+                c.drawRightString(x_total, y, precio)
+                y -= paso
             
             y -= 2 * mm
             c.line(2*mm, y, ANCHO_PAPEL - 2*mm, y)